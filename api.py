@@ -1,14 +1,25 @@
 import joblib
 import pandas as pd
 import numpy as np
-import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from datetime import datetime, timedelta
 from math import radians, asin, sqrt, cos, sin
 import sys
+import threading
+import time
 import traceback
 import os
 
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from live_feed import LiveFeedPoller
+from live_stats import SystemStatsEngine
+from gtfs_index import StopSpatialIndex, TransitNetwork, expand_row_ranges, haversine_km_vectorized
+from gtfs_cache import load_gtfs_store
+from journey_planner import live_trip_delays, plan_journeys
+from vehicle_tracker import VehicleTracker
+from prediction import SegmentModel, SegmentPredictionCache, SegmentScoringPool
+from metrics import TIMING_REQUEST_HEADER, finish_request_timing, profiler, record_failure, registry, span, start_request_timing, timed
+
 # --- Master Cleaner Function to handle NaN for JSON ---
 def replace_nan_with_none(obj):
     if isinstance(obj, dict): return {k: replace_nan_with_none(v) for k, v in obj.items()}
@@ -17,7 +28,25 @@ def replace_nan_with_none(obj):
     return obj
 
 # --- Configuration ---
-LIVE_API_URL = "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=yourkey"
+LIVE_API_URL = os.environ.get('LIVE_API_URL', "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=yourkey")   # point at feed_replay.py to run offline
+LIVE_FEED_MIN_POLL_SECONDS = 10   # Delhi OTD refreshes vehicle positions roughly every 10s
+LIVE_FEED_MAX_POLL_SECONDS = 60
+LIVE_FEED_STALE_AFTER_SECONDS = 120
+SEGMENT_CACHE_MAX_ENTRIES = 250_000
+UPCOMING_DEPARTURES_COUNT = 3
+SEGMENT_CACHE_PREWARM = True   # score active routes for the new hour as soon as it starts
+STATS_WINDOWS_SECONDS = (300, 900)
+PROFILER_ENDPOINT_ENABLED = os.environ.get('PROFILER_ENDPOINT_ENABLED') == '1'   # /debug/profiler is off unless explicitly enabled
+PROFILE_OUTPUT_DIR = 'profiles'
+# Worker processes for large segment-scoring batches; opt-in (0 scores every batch in the request thread). Every API
+# process forks its own pool, so with several server workers (gunicorn/uvicorn --workers, the reloader) keep
+# server workers x PREDICTION_POOL_WORKERS within the host's cores and memory.
+PREDICTION_POOL_WORKERS = int(os.environ.get('PREDICTION_POOL_WORKERS', 0))
+PREDICTION_POOL_BATCH_ROWS = 2000   # uncached segments per worker chunk; smaller batches stay in-process
+MODEL_PATH = 'bus_eta_model.pkl'
+TRACKED_SPEED_MIN_KMH = 3   # slower buses (dwelling, jammed) fall back to the model for the rest of their current segment
+PLANNER_MAX_TRANSFERS = 3
+PLANNER_TIME_BUDGET_SECONDS = 0.25   # RAPTOR rounds stop past this; the journeys found so far are returned
 
 # --- Initialize the Flask App ---
 app = Flask(__name__)
@@ -25,207 +54,427 @@ app = Flask(__name__)
 # --- Load Models and Static Data ONCE ---
 print("Loading all necessary data...")
 try:
-    model = joblib.load('bus_eta_model.pkl')
-    stops_df = pd.read_csv('stops.csv')
-    trips_df = pd.read_csv('trips.csv')
-    stop_times_df = pd.read_csv('stop_times.csv')
-    routes_df = pd.read_csv('routes.csv')
-    route_map = pd.merge(pd.merge(stop_times_df, trips_df, on='trip_id'), stops_df, on='stop_id')
-    print("Model and map data loaded successfully!")
+    model = joblib.load(MODEL_PATH)
+    # Static GTFS comes memory-mapped from the compiled cache (built from the CSVs on first run)
+    gtfs_store = load_gtfs_store()
+    stops_df, routes_df = gtfs_store.stops_df, gtfs_store.routes_df
+    trip_index, route_pattern_index, departure_timetable = gtfs_store.trip_index, gtfs_store.route_pattern_index, gtfs_store.departure_timetable
+    transit_network = gtfs_store.transit_network
+    stop_names = dict(zip(stops_df['stop_id'], stops_df['stop_name']))
+    route_names = dict(zip(routes_df['route_id'], routes_df['route_short_name']))
+    stop_spatial_index = StopSpatialIndex(stops_df['stop_lat'], stops_df['stop_lon'])
+    segment_cache = SegmentPredictionCache(maxsize=SEGMENT_CACHE_MAX_ENTRIES)
+    segment_model = SegmentModel(model, trip_index.trip_route_ids, stops_df['stop_id'], cache=segment_cache)
+    print(f"Model and map data loaded successfully! Indexed {len(trip_index)} trips in {len(route_pattern_index)} route patterns.")
 except FileNotFoundError as e:
     print(f"FATAL ERROR: Could not load necessary file: {e}. The API will not function correctly.")
-    model, stops_df, trips_df, stop_times_df, routes_df, route_map = (None,)*6
+    model, gtfs_store, stops_df, routes_df, trip_index, route_pattern_index, departure_timetable, transit_network, stop_names, route_names, stop_spatial_index, segment_cache, segment_model = (None,)*13
+
+# --- Shared Live Feed Poller ---
+feed_poller = LiveFeedPoller(LIVE_API_URL, min_interval=LIVE_FEED_MIN_POLL_SECONDS, max_interval=LIVE_FEED_MAX_POLL_SECONDS, stale_after=LIVE_FEED_STALE_AFTER_SECONDS)
+
+# --- Segment Cache Prewarming ---
+def prewarm_segment_cache(now=None):
+    """Scores every segment of the routes that currently have live buses, filling the cache for this hour."""
+    vehicles = feed_poller.current().vehicles
+    if segment_model is None or vehicles is None or vehicles.empty: return 0
+    active_route_ids = {route_id for trip_id in vehicles['trip_id'].dropna().unique() if (route_id := trip_index.route_for_trip(trip_id)) is not None}
+    trip_positions = np.flatnonzero(np.isin(trip_index.trip_route_ids, list(active_route_ids)))
+    rows, counts, _ = expand_row_ranges(trip_index.offsets[trip_positions], trip_index.offsets[trip_positions + 1] - 1)
+    segments = pd.DataFrame({'route_id': np.repeat(trip_index.trip_route_ids[trip_positions], counts), 'stop_id': trip_index.stop_ids_at(rows), 'stop_sequence': trip_index.stop_sequences[rows]}).drop_duplicates()
+    segment_model.predict(segments['route_id'].to_numpy(), segments['stop_id'].to_numpy(), segments['stop_sequence'].to_numpy(), datetime.now() if now is None else now)
+    return len(segments)
+
+def _prewarm_segment_cache_hourly():
+    while True:
+        now = datetime.now(); next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        time.sleep((next_hour - now).total_seconds() + 1)
+        try:
+            with span('prewarm_segment_cache'): print(f"Prewarmed {prewarm_segment_cache()} segment predictions for {datetime.now():%H}:00.")
+        except Exception as e:
+            record_failure('prewarm_segment_cache', e)
 
 # --- Core Helper Functions ---
 def haversine(lat1, lon1, lat2, lon2):
     lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2]); dlon = lon2 - lon1; dlat = lat2 - lat1; a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2; c = 2 * asin(sqrt(a)); r = 6371; return c * r
 
 def find_stops_near_vectorized(coords, radius_km=0.5):
+    """Stops within radius_km of coords, nearest first, with a distance_km column."""
     if stops_df is None: return pd.DataFrame()
-    stops_lat_rad = np.radians(stops_df['stop_lat'].values); stops_lon_rad = np.radians(stops_df['stop_lon'].values)
-    user_lat_rad = np.radians(coords['lat']); user_lon_rad = np.radians(coords['lon'])
-    dlon = stops_lon_rad - user_lon_rad; dlat = stops_lat_rad - user_lat_rad
-    a = np.sin(dlat / 2)**2 + np.cos(user_lat_rad) * np.cos(stops_lat_rad) * np.sin(dlon / 2)**2
-    c = 2 * np.arcsin(np.sqrt(a)); distances_km = 6371 * c
-    return stops_df[distances_km <= radius_km]
+    positions, distances = stop_spatial_index.query_radius(coords['lat'], coords['lon'], radius_km)
+    return stops_df.iloc[positions].assign(distance_km=distances)
+
+def find_nearest_stops(coords, k=1):
+    """The k stops nearest to coords regardless of distance, nearest first, with a distance_km column."""
+    if stops_df is None: return pd.DataFrame()
+    positions, distances = stop_spatial_index.query_nearest(coords['lat'], coords['lon'], k)
+    return stops_df.iloc[positions].assign(distance_km=distances)
+
+def find_stops_near_batch(coords_list, radius_km=0.5):
+    """find_stops_near_vectorized for many points in one tree query; one DataFrame per point."""
+    if stops_df is None: return [pd.DataFrame() for _ in coords_list]
+    results = stop_spatial_index.query_radius_batch([c['lat'] for c in coords_list], [c['lon'] for c in coords_list], radius_km)
+    return [stops_df.iloc[positions].assign(distance_km=distances) for positions, distances in results]
 
 def fetch_live_bus_data():
-    try:
-        sys.path.append(os.path.dirname(os.path.realpath(__file__))); import gtfs_realtime_pb2
-        response = requests.get(LIVE_API_URL, timeout=15); response.raise_for_status(); feed = gtfs_realtime_pb2.FeedMessage(); feed.ParseFromString(response.content)
-        data = [{'vehicle_id': e.vehicle.vehicle.id, 'trip_id': e.vehicle.trip.trip_id if e.vehicle.HasField('trip') else None, 'latitude': e.vehicle.position.latitude, 'longitude': e.vehicle.position.longitude} for e in feed.entity if e.HasField('vehicle')]
-        return pd.DataFrame(data) if data else None
-    except Exception as e:
-        print(f"An error occurred while fetching live data: {e}", file=sys.stderr); return None
+    """Returns the vehicles of the latest shared feed snapshot (no network I/O on the request path)."""
+    return feed_poller.current().vehicles
+
+def get_current_segment_rows(live_lat, live_lon, trip_id):
+    """Returns (last_row, next_row, progress) in trip_index for one bus; rows are None if the trip is unknown."""
+    if trip_index is None: return None, None, 0.0
+    last_rows, progress, _ = trip_index.locate_vehicles([trip_id], [live_lat], [live_lon])
+    if last_rows[0] < 0: return None, None, 0.0
+    return int(last_rows[0]), int(last_rows[0]) + 1, float(progress[0])
+
+def locate_buses(buses_df):
+    """(last_rows, progress, segment_speed_kmh) per bus, from the vehicle tracker where it knows the bus; the rest are snapped now."""
+    trip_ids = buses_df['trip_id'].tolist()
+    if vehicle_tracker is None or 'vehicle_id' not in buses_df:
+        last_rows, progress, _ = trip_index.locate_vehicles(trip_ids, buses_df['latitude'].to_numpy(), buses_df['longitude'].to_numpy())
+        return last_rows, progress, np.full(len(trip_ids), np.nan)
+    last_rows, progress, speeds = vehicle_tracker.lookup(buses_df['vehicle_id'].tolist(), trip_ids)
+    untracked = np.flatnonzero(last_rows < 0)
+    if len(untracked):
+        last_rows[untracked], progress[untracked], _ = trip_index.locate_vehicles([trip_ids[i] for i in untracked], buses_df['latitude'].to_numpy()[untracked], buses_df['longitude'].to_numpy()[untracked])
+    return last_rows, progress, speeds
 
 def get_current_segment(live_lat, live_lon, trip_id):
-    if route_map is None: return None, None
-    stops_on_trip = route_map[route_map['trip_id'] == trip_id].sort_values('stop_sequence')
-    if stops_on_trip.empty: return None, None
-    stops_on_trip['distance_to_bus'] = stops_on_trip.apply(lambda row: haversine(live_lat, live_lon, row['stop_lat'], row['stop_lon']), axis=1)
-    closest_stop = stops_on_trip.loc[stops_on_trip['distance_to_bus'].idxmin()]
-    last_stop_df = stops_on_trip[stops_on_trip['stop_sequence'] < closest_stop['stop_sequence']]
-    last_stop = closest_stop if last_stop_df.empty else last_stop_df.iloc[-1]
-    next_stop_df = stops_on_trip[stops_on_trip['stop_sequence'] > last_stop['stop_sequence']]
-    next_stop = None if next_stop_df.empty else next_stop_df.iloc[0]
-    return last_stop, next_stop
-
-
-def find_next_scheduled_departure(trip_id, start_stop_id):
-    """Finds the next scheduled departure time for a specific trip and start stop."""
+    last_row, next_row, _ = get_current_segment_rows(live_lat, live_lon, trip_id)
+    if last_row is None: return None, None
+    return trip_index.stop_record(last_row, stop_names), trip_index.stop_record(next_row, stop_names)
+
+
+def find_next_scheduled_departures(route_id, start_stop_id, n=3):
+    """Finds the next n scheduled departures of any trip of the route from the start stop."""
     try:
         now = datetime.now()
         current_time_in_seconds = now.hour * 3600 + now.minute * 60 + now.second
-        
-        # Find all scheduled stops for this specific trip
-        trip_schedule = stop_times_df[stop_times_df['trip_id'] == trip_id]
-        
-        # Find the specific departure for the start stop on that trip
-        departure_row = trip_schedule[trip_schedule['stop_id'] == start_stop_id]
-        if departure_row.empty: return None
-
-        for dep_time_str in sorted(departure_row['departure_time'].unique()):
-            dep_h, dep_m, dep_s = map(int, dep_time_str.split(':'))
-            departure_in_seconds = dep_h * 3600 + dep_m * 60 + dep_s
-            if departure_in_seconds >= current_time_in_seconds:
-                # Format the time back to a user-friendly string
-                return (datetime.min + timedelta(seconds=departure_in_seconds)).strftime('%I:%M %p')
-        return None # No more departures for today
-    except Exception:
-        return None
+        departures = departure_timetable.next_departures(route_id, trip_index.stop_code(start_stop_id), current_time_in_seconds, n)
+        # Format the times back to user-friendly strings
+        return [(datetime.min + timedelta(seconds=int(departure_in_seconds % (24 * 3600)))).strftime('%I:%M %p') for departure_in_seconds in departures]
+    except Exception as e:
+        record_failure('find_next_scheduled_departures', e); return []
 
 # --- Logic Functions (Cleaned Up) ---
+@timed('plan_trip_logic')
 def plan_trip_logic(start_coords, end_coords):
     nearby_start_stops = find_stops_near_vectorized(start_coords)
     nearby_end_stops = find_stops_near_vectorized(end_coords)
     if nearby_start_stops.empty or nearby_end_stops.empty: return []
-    start_segments = route_map[route_map['stop_id'].isin(nearby_start_stops['stop_id'])]
-    end_segments = route_map[route_map['stop_id'].isin(nearby_end_stops['stop_id'])]
-    merged = pd.merge(start_segments, end_segments, on='trip_id', suffixes=('_start', '_end'))
-    valid_trips = merged[merged['stop_sequence_start'] < merged['stop_sequence_end']]
-    
+    start_distances = dict(zip(nearby_start_stops['stop_id'], nearby_start_stops['distance_km']))
+    end_distances = dict(zip(nearby_end_stops['stop_id'], nearby_end_stops['distance_km']))
+
     detailed_journeys = {}
-    for index, trip in valid_trips.iterrows():
-        route_id = trip['route_id_start']
-        start_stop_id = trip['stop_id_start']
-        end_stop_id = trip['stop_id_end']
-        journey_key = f"{route_id}-{start_stop_id}-{end_stop_id}"
+    connections = route_pattern_index.connecting_patterns(trip_index.stop_codes_of(list(start_distances)), trip_index.stop_codes_of(list(end_distances)))
+    for pattern, start_stop_code, end_stop_code in connections:
+        route_id = route_pattern_index.pattern_route_ids[pattern]
+        start_stop_id, end_stop_id = trip_index.stop_id_table[[start_stop_code, end_stop_code]].tolist()
+        journey_key = (route_id, start_stop_id, end_stop_id)
         if journey_key not in detailed_journeys:
-            route_name_series = routes_df[routes_df['route_id'] == route_id]['route_short_name']
-            route_name = route_name_series.iloc[0] if not route_name_series.empty else f"Route {int(route_id)}"
-            next_departure = find_next_scheduled_departure(trip['trip_id'], start_stop_id)
+            route_name = route_names.get(route_id, f"Route {int(route_id)}")
+            upcoming_departures = find_next_scheduled_departures(route_id, start_stop_id, n=UPCOMING_DEPARTURES_COUNT)
             detailed_journeys[journey_key] = {
                 'route_id': int(route_id), 'route_name': route_name,
-                'start_stop': trip['stop_name_start'], 'end_stop': trip['stop_name_end'],
-                'next_scheduled_departure': next_departure
+                'start_stop': stop_names.get(start_stop_id), 'end_stop': stop_names.get(end_stop_id),
+                'next_scheduled_departure': upcoming_departures[0] if upcoming_departures else None,
+                'upcoming_departures': upcoming_departures
             }
-    return list(detailed_journeys.values())
+    # Closest boarding and alighting stops first
+    return [journey for key, journey in sorted(detailed_journeys.items(), key=lambda item: (start_distances[item[0][1]], end_distances[item[0][2]]))]
+
+_live_trip_delays = (None, None)   # (snapshot version, per-trip delays), so the planner snaps the buses once per snapshot
+
+def get_live_trip_delays(snapshot):
+    """Per-trip live delays for the journey planner (None when no buses are live)."""
+    global _live_trip_delays
+    vehicles = snapshot.vehicles
+    if vehicles is None or vehicles.empty: return None
+    version, delays = _live_trip_delays
+    if version != snapshot.version:
+        observed_at = datetime.fromtimestamp(snapshot.feed_timestamp or snapshot.fetched_at)
+        with span('live_trip_delays'):
+            delays = live_trip_delays(trip_index, vehicles['trip_id'].tolist(), vehicles['latitude'].to_numpy(), vehicles['longitude'].to_numpy(),
+                                      observed_at.hour * 3600 + observed_at.minute * 60 + observed_at.second, located=locate_buses(vehicles)[:2])
+        _live_trip_delays = (snapshot.version, delays)
+    return delays
+
+def format_clock(seconds):
+    return (datetime.min + timedelta(seconds=int(seconds % (24 * 3600)))).strftime('%I:%M %p')
+
+def format_journey_leg(leg):
+    if leg['mode'] == 'walk':
+        return {'mode': 'walk', 'from_stop': stop_names.get(leg['from_stop_id']), 'to_stop': stop_names.get(leg['to_stop_id']), 'minutes': round(leg['seconds'] / 60, 1)}
+    trip = leg['trip_position']
+    return {'mode': 'bus', 'route_id': int(leg['route_id']), 'route_name': route_names.get(leg['route_id'], f"Route {int(leg['route_id'])}"), 'trip_id': trip_index.trip_ids[trip:trip + 1].tolist()[0],
+            'from_stop': stop_names.get(leg['from_stop_id']), 'to_stop': stop_names.get(leg['to_stop_id']), 'stops': leg['stops'],
+            'departure_time': format_clock(leg['departure_seconds']), 'arrival_time': format_clock(leg['arrival_seconds']), 'live_delay_minutes': round(leg['delay_seconds'] / 60, 1)}
+
+@timed('plan_journeys')
+def plan_multi_leg_journeys(start_coords, end_coords, snapshot=None, now=None):
+    """Journeys with up to PLANNER_MAX_TRANSFERS changes, one per transfer count that arrives earlier than any with fewer.
+
+    Runs on today's schedule, with live delays from the snapshot's buses.
+    """
+    if transit_network is None: return {'options': [], 'truncated': False}
+    try:
+        nearby_start_stops = find_stops_near_vectorized(start_coords); nearby_end_stops = find_stops_near_vectorized(end_coords)
+        if nearby_start_stops.empty or nearby_end_stops.empty: return {'options': [], 'truncated': False}
+        origins = transit_network.stop_positions(nearby_start_stops['stop_id'].to_numpy()); targets = transit_network.stop_positions(nearby_end_stops['stop_id'].to_numpy())
+        walk_seconds = lambda stops: np.ceil(stops['distance_km'].to_numpy() * TransitNetwork.WALK_SECONDS_PER_KM).astype(np.int64)
+        now = datetime.now() if now is None else now
+        plan = plan_journeys(transit_network, origins[origins >= 0], walk_seconds(nearby_start_stops)[origins >= 0], targets[targets >= 0], walk_seconds(nearby_end_stops)[targets >= 0],
+                             now.hour * 3600 + now.minute * 60 + now.second, max_transfers=PLANNER_MAX_TRANSFERS, time_budget_seconds=PLANNER_TIME_BUDGET_SECONDS,
+                             trip_delays=None if snapshot is None else get_live_trip_delays(snapshot))
+        options = [{'departure_time': format_clock(journey['departure_seconds']), 'arrival_time': format_clock(journey['arrival_seconds']),
+                    'duration_minutes': round((journey['arrival_seconds'] - journey['departure_seconds']) / 60, 1), 'transfers': journey['transfers'],
+                    'legs': [format_journey_leg(leg) for leg in journey['legs'] if leg['mode'] == 'bus' or leg['seconds'] > 0]} for journey in plan.journeys]
+        return {'options': options, 'truncated': plan.truncated}
+    except Exception as e:
+        record_failure('plan_multi_leg_journeys', e); return {'options': [], 'truncated': False}
+
+def get_predictions_for_buses(buses_df, destination_stop, now=None):
+    """ETA details for every bus in buses_df towards destination_stop (None where a bus won't reach it).
+
+    All remaining segments of all buses are scored in one model call; each bus's
+    ETA is the sum of its own segments. On the segment it is on, a bus the
+    tracker has seen moving is timed at its observed speed over the distance
+    left, otherwise the model's time is scaled by the unfinished fraction.
+    """
+    now = datetime.now() if now is None else now
+    records = buses_df[['vehicle_id', 'trip_id']].to_dict('records')
+    if not records: return []
+    destination = destination_stop.iloc[0]
+    with span('locate_vehicles'): last_rows, progress, speeds = locate_buses(buses_df)
+    with span('find_destination_rows'):
+        destination_rows = np.array([-1 if last_row < 0 or (row := trip_index.find_stop_row(bus['trip_id'], destination['stop_id'], after_row=last_row)) is None else row
+                                     for bus, last_row in zip(records, last_rows.tolist())], dtype=np.int64)
+    reachable = destination_rows > last_rows
+    rows, counts, group_starts = expand_row_ranges(np.where(reachable, last_rows, 0), np.where(reachable, destination_rows, 0))
+    owners = np.repeat(np.arange(len(records)), counts)
+    segment_seconds = segment_model.predict(buses_df['route_id'].to_numpy()[owners], trip_index.stop_ids_at(rows), trip_index.stop_sequences[rows], now)
+    current_rows = last_rows[reachable]; moving = speeds[reachable] >= TRACKED_SPEED_MIN_KMH
+    remaining_km = (1.0 - progress[reachable]) * haversine_km_vectorized(*trip_index.stop_coords_at(current_rows), *trip_index.stop_coords_at(current_rows + 1))
+    segment_seconds[group_starts[reachable]] = np.where(moving, remaining_km / np.where(moving, speeds[reachable], 1.0) * 3600, segment_seconds[group_starts[reachable]] * (1.0 - progress[reachable]))
+    total_predicted_seconds = np.bincount(owners, weights=segment_seconds, minlength=len(records))
+
+    predictions = []
+    for i, bus in enumerate(records):
+        if not reachable[i]: predictions.append(None); continue
+        eta_time = now + timedelta(seconds=float(total_predicted_seconds[i]))
+        predictions.append({"vehicle_id": bus['vehicle_id'], "from_stop": stop_names.get(trip_index.stop_ids_at(last_rows[i])), "to_stop": stop_names.get(trip_index.stop_ids_at(last_rows[i] + 1)), "final_destination_stop": destination['stop_name'], "final_eta": eta_time.strftime('%I:%M:%S %p')})
+    return predictions
 
 def get_prediction_for_bus(bus_series, destination_stop):
     try:
-        bus_lat, bus_lon, bus_trip_id = bus_series['latitude'], bus_series['longitude'], bus_series['trip_id']
-        stops_on_trip = route_map[route_map['trip_id'] == bus_trip_id].sort_values('stop_sequence')
-        if stops_on_trip.empty: return None
-        last_stop, next_stop = get_current_segment(bus_lat, bus_lon, bus_trip_id)
-        if last_stop is None or next_stop is None: return None
-        if destination_stop.iloc[0]['stop_sequence'] <= last_stop['stop_sequence']: return None
-        now = datetime.now()
-        base_features = {'route_id': int(bus_series['route_id']), 'hour_of_day': now.hour, 'monday': 1 if now.weekday() == 0 else 0, 'tuesday': 1 if now.weekday() == 1 else 0, 'wednesday': 1 if now.weekday() == 2 else 0, 'thursday': 1 if now.weekday() == 3 else 0, 'friday': 1 if now.weekday() == 4 else 0, 'saturday': 1 if now.weekday() == 5 else 0, 'sunday': 1 if now.weekday() == 6 else 0}
-        
-        current_features = base_features.copy()
-        current_features['stop_id'] = int(last_stop['stop_id']); current_features['stop_sequence'] = int(last_stop['stop_sequence'])
-        features_df = pd.DataFrame(current_features, index=[0]); features_df['route_id'] = features_df['route_id'].astype('category'); features_df['stop_id'] = features_df['stop_id'].astype('category')
-        full_travel_time_prediction = model.predict(features_df)[0]
-        
-        total_segment_dist = haversine(last_stop['stop_lat'], last_stop['stop_lon'], next_stop['stop_lat'], next_stop['stop_lon'])
-        dist_from_start = haversine(last_stop['stop_lat'], last_stop['stop_lon'], bus_lat, bus_lon)
-        fraction_remaining = 1.0 - (dist_from_start / total_segment_dist) if total_segment_dist > 0 else 0
-        if fraction_remaining < 0: fraction_remaining = 0
-        remaining_time_for_current_segment = full_travel_time_prediction * fraction_remaining
-
-        total_future_time = 0
-        future_stops = stops_on_trip[(stops_on_trip['stop_sequence'] > last_stop['stop_sequence']) & (stops_on_trip['stop_sequence'] <= destination_stop.iloc[0]['stop_sequence'])]
-        start_of_segment = last_stop
-        for index, end_of_segment in future_stops.iterrows():
-            future_features = base_features.copy()
-            future_features['stop_id'] = int(start_of_segment['stop_id']); future_features['stop_sequence'] = int(start_of_segment['stop_sequence'])
-            future_features_df = pd.DataFrame(future_features, index=[0]); future_features_df['route_id'] = future_features_df['route_id'].astype('category'); future_features_df['stop_id'] = future_features_df['stop_id'].astype('category')
-            segment_prediction = model.predict(future_features_df)[0]
-            total_future_time += segment_prediction
-            start_of_segment = end_of_segment
-            
-        total_predicted_seconds = remaining_time_for_current_segment + total_future_time
-        eta_time = datetime.now() + timedelta(seconds=total_predicted_seconds)
-        
-        return {"vehicle_id": bus_series['vehicle_id'], "from_stop": last_stop['stop_name'], "to_stop": next_stop['stop_name'], "final_destination_stop": destination_stop.iloc[0]['stop_name'], "final_eta": eta_time.strftime('%I:%M:%S %p')}
-    except Exception:
-        return None
-
-def get_delay_for_bus_segment(bus_series):
+        return get_predictions_for_buses(pd.DataFrame([dict(bus_series)]), destination_stop)[0]
+    except Exception as e:
+        record_failure('get_prediction_for_bus', e); return None
+
+def get_delays_for_buses(buses_df, last_rows=None, now=None):
+    """Predicted minus scheduled seconds on each bus's current segment, scored in one model call (NaN where unknown)."""
+    now = datetime.now() if now is None else now
+    if last_rows is None:
+        with span('locate_vehicles'): last_rows, _, _ = locate_buses(buses_df)
+    delays = np.full(len(buses_df), np.nan)
+    located = np.flatnonzero(last_rows >= 0); rows = last_rows[located]
+    departure_in_seconds = trip_index.departure_seconds[rows].astype(np.int64); arrival_in_seconds = trip_index.arrival_seconds[rows + 1].astype(np.int64)
+    has_times = (departure_in_seconds >= 0) & (arrival_in_seconds >= 0)
+    located, rows, departure_in_seconds, arrival_in_seconds = located[has_times], rows[has_times], departure_in_seconds[has_times], arrival_in_seconds[has_times]
+    if len(located) == 0: return delays
+    full_travel_time_prediction = segment_model.predict(buses_df['route_id'].to_numpy()[located], trip_index.stop_ids_at(rows), trip_index.stop_sequences[rows], now)
+    arrival_in_seconds = np.where(arrival_in_seconds < departure_in_seconds, arrival_in_seconds + 24 * 3600, arrival_in_seconds)
+    delays[located] = full_travel_time_prediction - (arrival_in_seconds - departure_in_seconds)
+    return delays
+
+def get_delay_for_bus_segment(bus_series, last_row=None):
     try:
-        bus_lat, bus_lon, bus_trip_id = bus_series['latitude'], bus_series['longitude'], bus_series['trip_id']
-        last_stop, next_stop = get_current_segment(bus_lat, bus_lon, bus_trip_id)
-        if last_stop is None or next_stop is None: return None
-        now = datetime.now()
-        features = {'route_id': int(bus_series['route_id']), 'stop_id': int(last_stop['stop_id']),'stop_sequence': int(last_stop['stop_sequence']), 'hour_of_day': now.hour,'monday': 1 if now.weekday() == 0 else 0, 'tuesday': 1 if now.weekday() == 1 else 0,'wednesday': 1 if now.weekday() == 2 else 0, 'thursday': 1 if now.weekday() == 3 else 0,'friday': 1 if now.weekday() == 4 else 0, 'saturday': 1 if now.weekday() == 5 else 0,'sunday': 1 if now.weekday() == 6 else 0}
-        features_df = pd.DataFrame(features, index=[0]); features_df['route_id'] = features_df['route_id'].astype('category'); features_df['stop_id'] = features_df['stop_id'].astype('category')
-        full_travel_time_prediction = model.predict(features_df)[0]
-        dep_h, dep_m, dep_s = map(int, last_stop['departure_time'].split(':')); arr_h, arr_m, arr_s = map(int, next_stop['arrival_time'].split(':'))
-        departure_in_seconds = (dep_h * 3600) + (dep_m * 60) + dep_s; arrival_in_seconds = (arr_h * 3600) + (arr_m * 60) + arr_s
-        if arrival_in_seconds < departure_in_seconds: arrival_in_seconds += 24 * 3600
-        scheduled_travel_seconds = arrival_in_seconds - departure_in_seconds
-        return full_travel_time_prediction - scheduled_travel_seconds
-    except Exception:
-        return None
+        delay = get_delays_for_buses(pd.DataFrame([dict(bus_series)]), None if last_row is None else np.array([last_row], dtype=np.int64))[0]
+        return None if np.isnan(delay) else float(delay)
+    except Exception as e:
+        record_failure('get_delay_for_bus_segment', e); return None
+
+# --- Response Builders (shared by the Flask endpoints and the ASGI app in api_async.py) ---
+def build_system_stats(snapshot=None):
+    """Dashboard stats for a feed snapshot, as (payload, http_status)."""
+    if model is None: return {'error': 'Server not ready'}, 500
+    snapshot = feed_poller.current() if snapshot is None else snapshot; live_buses_df = snapshot.vehicles
+    if live_buses_df is None or live_buses_df.empty:
+        return {'active_buses_count': 0, 'avg_delay_minutes': 'N/A', 'on_time_percentage': 'N/A', 'routes_covered_count': 0, 'last_updated': datetime.now().isoformat(), 'feed': feed_poller.status(snapshot)}, 200
+    active_buses_count = len(live_buses_df)
+    with span('attach_routes'): live_buses_with_routes = trip_index.with_route_ids(live_buses_df)
+    routes_covered_count = live_buses_with_routes['route_id'].nunique()
+    with span('get_delays_for_buses'): delays = get_delays_for_buses(live_buses_with_routes)
+    delay_list = delays[~np.isnan(delays)]
+    avg_delay_minutes = float(np.mean(delay_list)) / 60 if len(delay_list) else 0
+    on_time_percentage = float(np.mean(np.abs(delay_list) <= 300)) * 100 if len(delay_list) else 100
+    result = {'active_buses_count': active_buses_count, 'avg_delay_minutes': avg_delay_minutes, 'on_time_percentage': on_time_percentage, 'routes_covered_count': routes_covered_count, 'last_updated': datetime.now().isoformat(), 'feed': feed_poller.status(snapshot)}
+    return replace_nan_with_none(result), 200
+
+def build_realtime_trip_plan(start_coords, end_coords, snapshot=None):
+    """Direct routes and multi-leg journeys between two points plus live ETAs on the active routes, as (payload, http_status)."""
+    snapshot = feed_poller.current() if snapshot is None else snapshot
+    return with_journeys(build_corridor_trip_plan(start_coords, end_coords, snapshot), start_coords, end_coords, snapshot)
+
+def build_corridor_trip_plan(start_coords, end_coords, snapshot):
+    """The part of the trip plan that only depends on the stops near both points (see trip_plan_corridor_key)."""
+    if model is None: return {'error': 'Server not ready'}, 500
+    possible_routes_details = plan_trip_logic(start_coords, end_coords)
+    live_buses_df = snapshot.vehicles
+    if live_buses_df is None or live_buses_df.empty:
+        return { 'trip_summary': {'possible_routes': possible_routes_details, 'active_routes_in_city': []}, 'final_plan': {}, 'message': 'No buses are currently live.', 'feed': feed_poller.status(snapshot) }, 200
+    with span('attach_routes'): live_buses_with_routes = trip_index.with_route_ids(live_buses_df)
+    active_route_ids = live_buses_with_routes['route_id'].unique()
+    active_routes_details = routes_df[routes_df['route_id'].isin(active_route_ids)][['route_id', 'route_short_name']].to_dict('records')
+    possible_route_ids = [r['route_id'] for r in possible_routes_details]
+    final_route_ids = sorted(list(set(possible_route_ids) & set(active_route_ids)))
+    
+    nearby_end_stops = find_stops_near_vectorized(end_coords)
+    if nearby_end_stops.empty: return {'message': 'Could not find any bus stops near your destination.'}, 200
+    destination_stop = nearby_end_stops.iloc[[0]]
+
+    final_trip_plan = {f"route_{route_id}": [] for route_id in final_route_ids}
+    buses_on_final_routes = live_buses_with_routes[live_buses_with_routes['route_id'].isin(final_route_ids)]
+    with span('get_predictions_for_buses'): predictions = get_predictions_for_buses(buses_on_final_routes, destination_stop)
+    for route_id, details in zip(buses_on_final_routes['route_id'].tolist(), predictions):
+        if details is not None: final_trip_plan[f"route_{route_id}"].append(details)
+    final_response = {'trip_summary': {'possible_routes': possible_routes_details, 'active_routes_in_city': active_routes_details}, 'final_plan': final_trip_plan, 'feed': feed_poller.status(snapshot)}
+    return replace_nan_with_none(final_response), 200
+
+def with_journeys(corridor_plan, start_coords, end_coords, snapshot):
+    """Adds the journeys for the exact points (their walks differ per rider) to a corridor plan, which may be shared and is not modified."""
+    payload, status = corridor_plan
+    if 'trip_summary' not in payload: return corridor_plan
+    journeys = plan_multi_leg_journeys(start_coords, end_coords, snapshot)
+    return {**payload, 'trip_summary': {**payload['trip_summary'], 'journeys': journeys}}, status
+
+def current_system_stats():
+    """Latest precomputed stats from the stats engine (falls back to a full compute before its first snapshot)."""
+    published = stats_engine.current() if stats_engine is not None else None
+    if published is None: return build_system_stats()
+    snapshot, payload, _ = published
+    return {**payload, 'feed': feed_poller.status(snapshot)}, 200
+
+def current_route_stats(route_id=None):
+    """Rolling per-route delay aggregates, optionally for a single route."""
+    published = stats_engine.current() if stats_engine is not None else None
+    if published is None: return {'error': 'Stats not ready yet'}, 503
+    snapshot, _, routes_payload = published
+    if route_id is not None: routes_payload = {route_id: routes_payload.get(route_id, {})}
+    return {'routes': replace_nan_with_none(routes_payload), 'feed': feed_poller.status(snapshot)}, 200
+
+def trip_plan_corridor_key(start_coords, end_coords, snapshot):
+    """Requests with the same nearby stops (nearest first) against the same snapshot get identical corridor plans."""
+    start_stop_ids = tuple(find_stops_near_vectorized(start_coords).get('stop_id', pd.Series(dtype=object)).tolist())
+    end_stop_ids = tuple(find_stops_near_vectorized(end_coords).get('stop_id', pd.Series(dtype=object)).tolist())
+    return start_stop_ids, end_stop_ids, snapshot.version
+
+def metrics_gauges():
+    """Point-in-time gauges for the /metrics exposition."""
+    snapshot = feed_poller.current(); age = snapshot.age_seconds()
+    gauges = {'feed_snapshot_version': ('Version of the published feed snapshot.', snapshot.version),
+              'feed_snapshot_age_seconds': ('Seconds since the feed produced the published snapshot.', age),
+              'feed_stale': ('1 if the feed has not been checked successfully recently.', feed_poller.status(snapshot)['stale']),
+              'feed_consecutive_failures': ('Failed feed polls since the last success.', feed_poller.consecutive_failures),
+              'feed_vehicles': ('Vehicles in the published snapshot.', 0 if snapshot.vehicles is None else len(snapshot.vehicles))}
+    if segment_cache is not None:
+        cache_stats = segment_cache.stats()
+        gauges['segment_cache'] = ('Segment prediction cache counters.', {'stat': {key: cache_stats[key] for key in ('size', 'hits', 'misses', 'evictions', 'invalidations')}})
+    if vehicle_tracker is not None:
+        gauges['vehicle_tracker'] = ('Vehicles held by the per-vehicle state tracker.', {'stat': vehicle_tracker.stats()})
+    if prediction_pool is not None:
+        gauges['prediction_pool'] = ('Prediction worker pool size and batch counters.', {'stat': prediction_pool.stats()})
+    return gauges
+
+def build_metrics_text(extra_gauges=None):
+    return registry.render({**metrics_gauges(), **(extra_gauges or {})})
+
+def toggle_profiler(action, interval_ms=5):
+    """start/stop/status for the sampling profiler, as (payload, http_status); stop returns folded stacks as text."""
+    if not PROFILER_ENDPOINT_ENABLED: return {'error': 'Not found'}, 404
+    if action == 'start':
+        started = profiler.start(interval=max(1.0, float(interval_ms)) / 1000)
+        return {'running': True, 'started': started, 'interval_ms': profiler.interval * 1000}, 200 if started else 409
+    if action == 'stop':
+        if not profiler.running: return {'error': 'Profiler is not running'}, 409
+        folded, path = profiler.stop(PROFILE_OUTPUT_DIR)
+        print(f"Wrote {path}")
+        return folded, 200
+    if action == 'status': return {'running': profiler.running, 'interval_ms': None if profiler.interval is None else profiler.interval * 1000}, 200
+    return {'error': 'Bad request: action must be start, stop or status'}, 400
+
+# --- Prediction Worker Pool ---
+# Forked before any background thread starts, so the workers inherit the loaded model and GTFS cache copy-on-write
+prediction_pool = SegmentScoringPool(segment_model, PREDICTION_POOL_WORKERS, MODEL_PATH, PREDICTION_POOL_BATCH_ROWS) if segment_model is not None and PREDICTION_POOL_WORKERS > 0 else None
+if prediction_pool is not None: segment_model.pool = prediction_pool
+
+# --- Background Services ---
+# Subscribers are attached before the poller starts so they see its first snapshot; the tracker
+# goes first so the stats engine's delays read positions from the same snapshot
+vehicle_tracker = VehicleTracker(trip_index) if model is not None else None
+if vehicle_tracker is not None: feed_poller.subscribe(vehicle_tracker.on_snapshot)
+stats_engine = SystemStatsEngine(trip_index.with_route_ids, get_delays_for_buses, windows=STATS_WINDOWS_SECONDS) if model is not None else None
+if stats_engine is not None: feed_poller.subscribe(stats_engine.on_snapshot)
+feed_poller.start()
+if SEGMENT_CACHE_PREWARM and segment_model is not None:
+    threading.Thread(target=_prewarm_segment_cache_hourly, name='segment-cache-prewarm', daemon=True).start()
+
+# --- Request Instrumentation ---
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.timing_token = start_request_timing() if request.headers.get(TIMING_REQUEST_HEADER) else None
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'request_started' not in g: return response   # a before_request hook failed first
+    registry.observe('request', request.url_rule.rule if request.url_rule is not None else 'unmatched', time.perf_counter() - g.request_started)
+    if g.timing_token is not None: response.headers['Server-Timing'] = finish_request_timing(g.timing_token)
+    return response
 
 # --- API Endpoints ---
 @app.route('/get-system-stats', methods=['GET'])
 def get_system_stats():
-    if model is None: return jsonify({'error': 'Server not ready'}), 500
     try:
-        live_buses_df = fetch_live_bus_data()
-        if live_buses_df is None or live_buses_df.empty:
-            return jsonify({'active_buses_count': 0, 'avg_delay_minutes': 'N/A', 'on_time_percentage': 'N/A', 'routes_covered_count': 0, 'last_updated': datetime.now().isoformat()})
-        active_buses_count = len(live_buses_df)
-        live_buses_with_routes = pd.merge(live_buses_df.dropna(subset=['trip_id']), trips_df, on='trip_id')
-        routes_covered_count = live_buses_with_routes['route_id'].nunique()
-        delay_list = [delay for bus in live_buses_with_routes.to_dict('records') if (delay := get_delay_for_bus_segment(bus)) is not None]
-        avg_delay_minutes = np.mean(delay_list) / 60 if delay_list else 0
-        on_time_percentage = (sum(1 for delay in delay_list if abs(delay) <= 300) / len(delay_list)) * 100 if delay_list else 100
-        result = {'active_buses_count': active_buses_count, 'avg_delay_minutes': avg_delay_minutes, 'on_time_percentage': on_time_percentage, 'routes_covered_count': routes_covered_count, 'last_updated': datetime.now().isoformat()}
-        return jsonify(replace_nan_with_none(result))
+        payload, status = current_system_stats()
+        return jsonify(payload), status
     except Exception as e:
         traceback.print_exc(); return jsonify({'error': str(e)}), 500
 
 @app.route('/get-realtime-trip-plan', methods=['POST'])
 def get_realtime_trip_plan():
-    if model is None: return jsonify({'error': 'Server not ready'}), 500
     try:
         data = request.get_json(); start_coords = data['start_coords']; end_coords = data['end_coords']
-        possible_routes_details = plan_trip_logic(start_coords, end_coords)
-        live_buses_df = fetch_live_bus_data()
-        if live_buses_df is None or live_buses_df.empty:
-            return jsonify({ 'trip_summary': {'possible_routes': possible_routes_details, 'active_routes_in_city': []}, 'final_plan': {}, 'message': 'No buses are currently live.' })
-        live_buses_with_routes = pd.merge(live_buses_df.dropna(subset=['trip_id']), trips_df, on='trip_id')
-        active_route_ids = live_buses_with_routes['route_id'].unique()
-        active_routes_details = routes_df[routes_df['route_id'].isin(active_route_ids)][['route_id', 'route_short_name']].to_dict('records')
-        possible_route_ids = [r['route_id'] for r in possible_routes_details]
-        final_route_ids = sorted(list(set(possible_route_ids) & set(active_route_ids)))
-        
-        nearby_end_stops = find_stops_near_vectorized(end_coords)
-        if nearby_end_stops.empty: return jsonify({'message': 'Could not find any bus stops near your destination.'})
-        destination_stop = nearby_end_stops.iloc[[0]]
-
-        final_trip_plan = {}
-        for route_id in final_route_ids:
-            buses_on_this_route = live_buses_with_routes[live_buses_with_routes['route_id'] == route_id]
-            bus_details_list = [details for bus in buses_on_this_route.to_dict('records') if (details := get_prediction_for_bus(bus, destination_stop)) is not None]
-            final_trip_plan[f"route_{route_id}"] = bus_details_list
-        final_response = {'trip_summary': {'possible_routes': possible_routes_details, 'active_routes_in_city': active_routes_details}, 'final_plan': final_trip_plan}
-        return jsonify(replace_nan_with_none(final_response))
+        payload, status = build_realtime_trip_plan(start_coords, end_coords)
+        return jsonify(payload), status
     except Exception as e:
         traceback.print_exc(); return jsonify({'error': str(e)}), 500
 
+@app.route('/get-route-stats', methods=['GET'])
+def get_route_stats():
+    route_id = request.args.get('route_id')
+    try:
+        route_id = None if route_id is None else int(route_id)
+    except ValueError:
+        return jsonify({'error': 'Bad request: route_id must be an integer'}), 400
+    payload, status = current_route_stats(route_id)
+    return jsonify(payload), status
+
+@app.route('/get-cache-stats', methods=['GET'])
+def get_cache_stats():
+    if segment_cache is None: return jsonify({'error': 'Server not ready'}), 500
+    return jsonify(segment_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(build_metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profiler', methods=['POST'])
+def debug_profiler():
+    payload, status = toggle_profiler(request.args.get('action', 'status'), request.args.get('interval_ms', 5, type=float))
+    if isinstance(payload, str): return Response(payload, status=status, mimetype='text/plain')
+    return jsonify(payload), status
+
 # --- Main execution block ---
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
@@ -0,0 +1,164 @@
+# api_async.py
+# ASGI entry point for the prediction API: `uvicorn api_async:app --port 5000`.
+#
+# Serves the same endpoints as the Flask app in api.py without tying up a
+# worker thread per request. The event loop only parses requests and writes
+# responses; the pandas/model work runs in a thread pool (NumPy and LightGBM
+# release the GIL for the heavy parts), upstream I/O stays in the shared
+# feed poller, and concurrent trip-plan requests for the same corridor share
+# a single computation.
+
+import asyncio
+import contextvars
+import json
+import time
+import traceback
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import api
+from metrics import TIMING_REQUEST_HEADER, add_request_stages, collect_stages, finish_request_timing, registry, start_request_timing
+
+# --- Configuration ---
+WORKER_THREADS = 4
+MAX_BODY_BYTES = 64 * 1024
+
+
+# --- Request Coalescing ---
+class RequestCoalescer:
+    """Runs at most one computation per key at a time; concurrent callers with the same key share its result."""
+
+    def __init__(self):
+        self._inflight = {}
+        self.started = 0; self.coalesced = 0
+
+    async def run(self, key, compute):
+        future = self._inflight.get(key)
+        if future is None:
+            self.started += 1
+            future = asyncio.ensure_future(compute()); self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: one client disconnecting must not cancel the work other callers are waiting on
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {'inflight': len(self._inflight), 'started': self.started, 'coalesced': self.coalesced}
+
+
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='api-worker')
+trip_plan_coalescer = RequestCoalescer()
+
+
+# --- Helpers ---
+def _json_default(obj):
+    if isinstance(obj, np.integer): return int(obj)
+    if isinstance(obj, np.floating): return float(obj)
+    if isinstance(obj, np.ndarray): return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+async def _send_json(send, payload, status=200, headers=()):
+    """Sends payload as JSON, or as plain text if it is already a string."""
+    if isinstance(payload, str): body = payload.encode('utf-8'); content_type = b'text/plain; version=0.0.4; charset=utf-8'
+    else: body = json.dumps(payload, default=_json_default).encode('utf-8'); content_type = b'application/json'
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _read_body(receive):
+    chunks = []; size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect': return None
+        chunk = message.get('body', b''); size += len(chunk)
+        if size > MAX_BODY_BYTES: return b''   # rejected as invalid JSON by the caller
+        chunks.append(chunk)
+        if not message.get('more_body', False): return b''.join(chunks)
+
+async def _offload(function, *args):
+    # run in a copy of this request's context so spans in the worker land in its timing breakdown
+    return await asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, function, *args)
+
+def _query_param(scope, name, default=None):
+    return parse_qs(scope.get('query_string', b'').decode()).get(name, [default])[0]
+
+
+# --- Endpoints ---
+async def get_system_stats(scope, receive):
+    return await _offload(api.current_system_stats)
+
+async def get_realtime_trip_plan(scope, receive):
+    body = await _read_body(receive)
+    if body is None: return None
+    try:
+        data = json.loads(body); start_coords = data['start_coords']; end_coords = data['end_coords']
+    except (KeyError, TypeError, ValueError) as e:
+        return {'error': f'Bad request: {e}'}, 400
+    snapshot = api.feed_poller.current()
+    key = await _offload(api.trip_plan_corridor_key, start_coords, end_coords, snapshot)
+    # Only the corridor part is shared; each caller gets the stages it took (so followers' Server-Timing isn't empty)
+    # and its own journeys, whose walks depend on the exact points
+    corridor_plan, stages = await trip_plan_coalescer.run(key, lambda: _offload(collect_stages, api.build_corridor_trip_plan, start_coords, end_coords, snapshot))
+    add_request_stages(stages)
+    return await _offload(api.with_journeys, corridor_plan, start_coords, end_coords, snapshot)
+
+async def get_route_stats(scope, receive):
+    route_id = _query_param(scope, 'route_id')
+    try:
+        route_id = None if route_id is None else int(route_id)
+    except ValueError:
+        return {'error': 'Bad request: route_id must be an integer'}, 400
+    return api.current_route_stats(route_id)
+
+async def get_cache_stats(scope, receive):
+    if api.segment_cache is None: return {'error': 'Server not ready'}, 500
+    return {**api.segment_cache.stats(), 'trip_plan_coalescing': trip_plan_coalescer.stats()}, 200
+
+async def get_metrics(scope, receive):
+    coalescing = trip_plan_coalescer.stats()
+    return await _offload(api.build_metrics_text, {'trip_plan_coalescing': ('Trip-plan request coalescing counters.', {'stat': coalescing})}), 200
+
+async def debug_profiler(scope, receive):
+    try:
+        interval_ms = float(_query_param(scope, 'interval_ms', 5))
+    except ValueError:
+        return {'error': 'Bad request: interval_ms must be a number'}, 400
+    return await _offload(api.toggle_profiler, _query_param(scope, 'action', 'status'), interval_ms)
+
+ROUTES = {('GET', '/get-system-stats'): get_system_stats,
+          ('POST', '/get-realtime-trip-plan'): get_realtime_trip_plan,
+          ('GET', '/get-route-stats'): get_route_stats,
+          ('GET', '/get-cache-stats'): get_cache_stats,
+          ('GET', '/metrics'): get_metrics,
+          ('POST', '/debug/profiler'): debug_profiler}
+
+
+# --- ASGI Application ---
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                api.feed_poller.start(); await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                api.feed_poller.stop(); executor.shutdown(wait=False); await send({'type': 'lifespan.shutdown.complete'}); return
+    if scope['type'] != 'http': return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        status = 405 if any(path == scope['path'] for _, path in ROUTES) else 404
+        await _send_json(send, {'error': 'Method not allowed' if status == 405 else 'Not found'}, status); return
+    started = time.perf_counter()
+    timing_token = start_request_timing() if dict(scope['headers']).get(TIMING_REQUEST_HEADER.lower().encode()) else None
+    try:
+        result = await handler(scope, receive)
+        if result is None: return   # client went away before sending its body
+        payload, status = result
+    except Exception as e:
+        traceback.print_exc(); payload, status = {'error': str(e)}, 500
+    finally:
+        registry.observe('request', scope['path'], time.perf_counter() - started)
+        headers = [(b'server-timing', finish_request_timing(timing_token).encode())] if timing_token is not None else []
+    await _send_json(send, payload, status, headers)
@@ -0,0 +1,188 @@
+# bench_api.py
+# End-to-end benchmark for the prediction API against a replayed feed.
+#
+#   python bench_api.py --recordings feed_recordings --server asgi --requests 2000 --concurrency 16
+#
+# Starts feed_replay.py's server on the recordings, launches the API
+# (Flask or ASGI) pointed at it through LIVE_API_URL, and drives
+# /get-system-stats and /get-realtime-trip-plan with a seeded
+# origin/destination mix. Reports throughput, latency percentiles and the
+# server's peak RSS, and writes them to bench_results/<commit>-<server>.json.
+# Pass --compare with an earlier result file to see the change per metric.
+# The same seed, request count and concurrency give the same workload on
+# every commit.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import requests
+
+from feed_replay import DEFAULT_RECORDINGS_DIR, start_replay_server
+from gtfs_cache import load_gtfs_store
+from gtfs_index import haversine_km_vectorized
+
+RESULTS_DIR = 'bench_results'
+SERVER_COMMANDS = {'flask': [sys.executable, '-m', 'flask', '--app', 'api', 'run', '--no-reload'],
+                   'asgi': [sys.executable, '-m', 'uvicorn', 'api_async:app', '--log-level', 'warning']}
+TRIP_LENGTH_KM = (1.0, 15.0)
+JITTER_DEGREES = 0.0015   # ~150 m, so riders don't all stand on the stop itself
+MAX_SAMPLING_ROUNDS = 100   # batches of stop pairs drawn before giving up on finding enough TRIP_LENGTH_KM trips
+
+
+# --- Workload ---
+def build_trip_requests(count, seed=0):
+    """Seeded (start_coords, end_coords) pairs. Stops are picked in proportion to how many trips serve them."""
+    store = load_gtfs_store(); stops = store.stops_df; rng = np.random.default_rng(seed)
+    served_ids = store.trip_index.stop_id_table; trips_per_stop = np.bincount(store.trip_index.stop_codes, minlength=len(served_ids))
+    weights = np.zeros(len(stops)); position = np.searchsorted(served_ids, stops['stop_id'].to_numpy())
+    known = (position < len(served_ids)) & (served_ids[np.minimum(position, len(served_ids) - 1)] == stops['stop_id'].to_numpy())
+    weights[known] = trips_per_stop[position[known]]
+    if weights.sum() == 0: raise ValueError("No stop in stops.csv is served by any trip; nothing to plan trips between.")
+    weights /= weights.sum()
+    lats = stops['stop_lat'].to_numpy(); lons = stops['stop_lon'].to_numpy()
+
+    pairs = []
+    for _ in range(MAX_SAMPLING_ROUNDS):
+        if len(pairs) >= count: break
+        origins = rng.choice(len(stops), size=count, p=weights); destinations = rng.choice(len(stops), size=count, p=weights)
+        distances = haversine_km_vectorized(lats[origins], lons[origins], lats[destinations], lons[destinations])
+        plausible = (distances >= TRIP_LENGTH_KM[0]) & (distances <= TRIP_LENGTH_KM[1])
+        for origin, destination in zip(origins[plausible], destinations[plausible]):
+            jitter = rng.uniform(-JITTER_DEGREES, JITTER_DEGREES, size=4)
+            pairs.append(([float(lats[origin] + jitter[0]), float(lons[origin] + jitter[1])], [float(lats[destination] + jitter[2]), float(lons[destination] + jitter[3])]))
+    if len(pairs) < count:
+        raise ValueError(f"Found only {len(pairs)} of {count} stop pairs {TRIP_LENGTH_KM[0]:g}-{TRIP_LENGTH_KM[1]:g} km apart in {MAX_SAMPLING_ROUNDS} rounds; "
+                         "the feed may be too small for this workload.")
+    return pairs[:count]
+
+def build_workload(count, stats_share=0.2, seed=0):
+    """A seeded, shuffled list of (endpoint, json body or None) requests."""
+    rng = np.random.default_rng(seed + 1)
+    is_stats = rng.random(count) < stats_share
+    trips = iter(build_trip_requests(int((~is_stats).sum()), seed))
+    return [('/get-system-stats', None) if stats else ('/get-realtime-trip-plan', dict(zip(('start_coords', 'end_coords'), next(trips)))) for stats in is_stats]
+
+
+# --- Server ---
+def start_api_server(server, port, feed_url):
+    command = SERVER_COMMANDS[server] + ['--port', str(port)]
+    return subprocess.Popen(command, env={**os.environ, 'LIVE_API_URL': feed_url}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def wait_until_ready(base_url, process, timeout=300):
+    """Blocks until the API has loaded its data and published its first feed snapshot."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None: raise RuntimeError(f"API server exited with code {process.returncode}")
+        try:
+            response = requests.get(base_url + '/get-system-stats', timeout=5)
+            if response.ok and (response.json().get('feed') or {}).get('snapshot_version', 0) >= 1: return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError("API server did not become ready")
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a process in MB (Linux /proc only; None elsewhere)."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+# --- Load ---
+def run_load(base_url, workload, concurrency):
+    """Sends every request with `concurrency` clients; returns (per-request (endpoint, latency_ms, status) list, wall seconds)."""
+    local = threading.local()
+
+    def send(item):
+        endpoint, body = item
+        session = getattr(local, 'session', None)
+        if session is None: session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = session.post(base_url + endpoint, json=body, timeout=60) if body is not None else session.get(base_url + endpoint, timeout=60)
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        return endpoint, (time.perf_counter() - started) * 1000, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool: results = list(pool.map(send, workload))
+    return results, time.perf_counter() - started
+
+def summarize(results, wall_seconds):
+    summary = {'requests': len(results), 'wall_seconds': round(wall_seconds, 3), 'throughput_rps': round(len(results) / wall_seconds, 2), 'endpoints': {}}
+    for endpoint in sorted({result[0] for result in results}):
+        latencies = np.array([latency for name, latency, _ in results if name == endpoint])
+        errors = sum(1 for name, _, status in results if name == endpoint and status != 200)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        summary['endpoints'][endpoint] = {'count': len(latencies), 'errors': errors, 'throughput_rps': round(len(latencies) / wall_seconds, 2), 'mean_ms': round(float(latencies.mean()), 2),
+                                          'p50_ms': round(float(p50), 2), 'p90_ms': round(float(p90), 2), 'p99_ms': round(float(p99), 2), 'max_ms': round(float(latencies.max()), 2)}
+    return summary
+
+
+# --- Reporting ---
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip())
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_report(result, baseline=None):
+    print(f"{result['commit']} {result['server']}: {result['summary']['throughput_rps']} req/s, peak RSS {result['peak_rss_mb']} MB")
+    print(f"{'endpoint':<28} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'rps':>8}")
+    for endpoint, stats in result['summary']['endpoints'].items():
+        row = f"{endpoint:<28} {stats['count']:>6} {stats['errors']:>6} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['throughput_rps']:>8.1f}"
+        before = (baseline or {}).get('summary', {}).get('endpoints', {}).get(endpoint)
+        if before: row += "   vs {}: p50 {:+.0%} p99 {:+.0%} rps {:+.0%}".format(baseline['commit'], stats['p50_ms'] / before['p50_ms'] - 1, stats['p99_ms'] / before['p99_ms'] - 1, stats['throughput_rps'] / before['throughput_rps'] - 1)
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the prediction API against a replayed feed.')
+    parser.add_argument('--recordings', default=DEFAULT_RECORDINGS_DIR)
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='asgi')
+    parser.add_argument('--port', type=int, default=5055); parser.add_argument('--replay-port', type=int, default=8900)
+    parser.add_argument('--replay-advance', type=float, default=10, help='seconds per recorded snapshot')
+    parser.add_argument('--requests', type=int, default=2000); parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16); parser.add_argument('--stats-share', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', help='earlier result JSON to compare against')
+    args = parser.parse_args()
+
+    replay_server, feed_url = start_replay_server(args.recordings, args.replay_port, args.replay_advance)
+    workload = build_workload(args.warmup + args.requests, args.stats_share, args.seed)
+    base_url = f"http://127.0.0.1:{args.port}"
+    process = start_api_server(args.server, args.port, feed_url)
+    try:
+        wait_until_ready(base_url, process)
+        run_load(base_url, workload[:args.warmup], args.concurrency)
+        results, wall_seconds = run_load(base_url, workload[args.warmup:], args.concurrency)
+        result = {'commit': git_revision(), 'server': args.server, 'recorded_at': datetime.now().isoformat(timespec='seconds'),
+                  'parameters': {key: value for key, value in vars(args).items() if key not in ('compare', 'port', 'replay_port')},
+                  'summary': summarize(results, wall_seconds), 'peak_rss_mb': peak_rss_mb(process.pid)}
+    finally:
+        process.terminate(); process.wait(timeout=30); replay_server.shutdown()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['commit']}-{args.server}.json")
+    with open(path, 'w') as f: json.dump(result, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+    print_report(result, baseline); print(f"Saved {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# bench_feed_decode.py
+# Microbenchmark: the original FeedMessage -> list of dicts -> DataFrame path
+# against the columnar decoder in feed_decoder.py, on recorded feed files.
+#
+#   python bench_feed_decode.py recordings/*.pb --repeat 20
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+import pandas as pd
+
+import gtfs_realtime_pb2
+from feed_decoder import VehiclePositionsDecoder
+
+
+def decode_with_messages(content):
+    """The pre-columnar path, kept verbatim as the baseline."""
+    feed = gtfs_realtime_pb2.FeedMessage(); feed.ParseFromString(content)
+    data = [{'vehicle_id': e.vehicle.vehicle.id, 'trip_id': e.vehicle.trip.trip_id if e.vehicle.HasField('trip') else None, 'latitude': e.vehicle.position.latitude, 'longitude': e.vehicle.position.longitude} for e in feed.entity if e.HasField('vehicle')]
+    return pd.DataFrame(data) if data else None
+
+def time_calls(function, content, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter(); function(content); timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+def check_same_vehicles(baseline, columnar):
+    """Both paths must agree on the columns the endpoints read."""
+    if baseline is None or columnar is None: return baseline is None and columnar is None
+    return (len(baseline) == len(columnar) and (baseline['vehicle_id'].to_numpy() == columnar['vehicle_id'].to_numpy()).all()
+            and baseline['trip_id'].fillna('\0').tolist() == columnar['trip_id'].fillna('\0').tolist()
+            and np.allclose(baseline['latitude'], columnar['latitude']) and np.allclose(baseline['longitude'], columnar['longitude']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare VehiclePositions decoders on recorded feeds.')
+    parser.add_argument('feeds', nargs='+', help='recorded VehiclePositions .pb files')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'feed':<40} {'vehicles':>8} {'messages ms':>12} {'columnar ms':>12} {'decode only ms':>15} {'speedup':>8}")
+    for path in args.feeds:
+        with open(path, 'rb') as f: content = f.read()
+        decoder = VehiclePositionsDecoder(); decoder.decode(content)   # warm the string table, as a running poller would be
+        columnar = lambda data: decoder.decode(data).to_frame()
+        baseline_frame = decode_with_messages(content); columnar_frame = columnar(content)
+        if not check_same_vehicles(baseline_frame, columnar_frame): print(f"{path}: decoders disagree, skipping"); continue
+
+        baseline_ms = statistics.median(time_calls(decode_with_messages, content, args.repeat))
+        columnar_ms = statistics.median(time_calls(columnar, content, args.repeat))
+        decode_ms = statistics.median(time_calls(decoder.decode, content, args.repeat))
+        vehicles = 0 if columnar_frame is None else len(columnar_frame)
+        print(f"{path[-40:]:<40} {vehicles:>8} {baseline_ms:>12.2f} {columnar_ms:>12.2f} {decode_ms:>15.2f} {baseline_ms / columnar_ms:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# feed_decoder.py
+# Columnar decoder for GTFS-realtime VehiclePositions feeds. It reads the
+# protobuf wire format straight into typed NumPy columns: apart from one
+# sequential pass that finds the entity boundaries, every nesting level is
+# decoded for all vehicles at once (one vectorized step per field), so a fetch
+# creates no message objects or per-vehicle dicts. String IDs are interned
+# once per decoder and stored as int32 codes into a shared string table.
+#
+# Field numbers follow gtfs-realtime.proto; anything not listed here (alerts,
+# trip updates, extensions, carriage details) is skipped by wire type.
+
+from array import array
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+NO_CODE = -1              # string column: field absent
+NO_VALUE = -1             # small-int column: field absent
+IN_TRANSIT_TO = 2         # proto default for VehiclePosition.current_status
+
+_VARINT_WIDTH = 10       # a varint never spans more bytes than this
+_FIXED_SIZES = np.array([0, 8, 0, -1, -1, 4, -1, -1])   # payload bytes by wire type beyond any varint; -1 = unsupported (groups)
+
+# FeedMessage
+_FEED_HEADER, _FEED_ENTITY = 1, 2
+# FeedHeader
+_HEADER_TIMESTAMP = 3
+# FeedEntity
+_ENTITY_VEHICLE = 4
+# VehiclePosition
+_VP_TRIP, _VP_POSITION, _VP_STOP_SEQUENCE, _VP_STATUS, _VP_TIMESTAMP, _VP_CONGESTION, _VP_STOP_ID, _VP_VEHICLE, _VP_OCCUPANCY = 1, 2, 3, 4, 5, 6, 7, 8, 9
+# TripDescriptor
+_TRIP_ID, _TRIP_START_TIME, _TRIP_START_DATE, _TRIP_ROUTE_ID, _TRIP_DIRECTION_ID = 1, 2, 3, 5, 6
+# VehicleDescriptor
+_VEHICLE_ID, _VEHICLE_LABEL = 1, 2
+# Position
+_POS_LATITUDE, _POS_LONGITUDE, _POS_BEARING, _POS_ODOMETER, _POS_SPEED = 1, 2, 3, 4, 5
+
+
+# --- Wire Format ---
+def _read_varint(buf, pos):
+    byte = buf[pos]; pos += 1
+    if byte < 0x80: return byte, pos
+    result = byte & 0x7F; shift = 7
+    while True:
+        byte = buf[pos]; pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80: return result, pos
+        shift += 7
+
+def _top_level_spans(buf):
+    """(header span or None, entity starts, entity ends) of a FeedMessage; the one sequential pass."""
+    pos = 0; end = len(buf); header = None; starts = array('q'); ends = array('q')
+    entity_key = _FEED_ENTITY << 3 | 2
+    while pos < end:
+        key = buf[pos]; pos += 1
+        if key == entity_key:   # hot path: one-byte key, then the entity length
+            length = buf[pos]
+            if length > 0x7F: length, pos = _read_varint(buf, pos)
+            else: pos += 1
+            starts.append(pos); pos += length; ends.append(pos)
+            continue
+        if key > 0x7F: key, pos = _read_varint(buf, pos - 1)
+        wire_type = key & 7
+        if wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            if key >> 3 == _FEED_ENTITY: starts.append(pos); ends.append(pos + length)
+            elif key >> 3 == _FEED_HEADER: header = (pos, pos + length)
+            pos += length
+        elif wire_type == 0: _, pos = _read_varint(buf, pos)
+        elif wire_type == 5: pos += 4
+        elif wire_type == 1: pos += 8
+        else: raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    if pos != end: raise ValueError("Truncated protobuf message")
+    return header, np.frombuffer(starts, dtype=np.int64) if starts else np.zeros(0, np.int64), np.frombuffer(ends, dtype=np.int64) if ends else np.zeros(0, np.int64)
+
+def _varints(data, positions):
+    """Decodes one varint at each position: (values as uint64, positions just past them).
+
+    Most keys and lengths fit in one byte, so only the rows still carrying a
+    continuation bit go on to the next byte.
+    """
+    byte = data[positions]; values = (byte & 0x7F).astype(np.uint64); after = positions + 1
+    pending = np.flatnonzero(byte >= 0x80); shift = 7
+    while len(pending):
+        if shift >= 7 * _VARINT_WIDTH: raise ValueError("Malformed protobuf varint")
+        byte = data[after[pending]]; after[pending] += 1
+        values[pending] |= (byte & 0x7F).astype(np.uint64) << np.uint64(shift)
+        pending = pending[byte >= 0x80]; shift += 7
+    return values, after
+
+def _scan(data, starts, ends):
+    """Every field of many messages at once, advancing all of them one field per step.
+
+    Returns (owner, field, wire_type, value, offset) arrays, where owner
+    indexes starts/ends, value is the varint (the byte length, for
+    length-delimited fields) and offset is where fixed-width or
+    length-delimited data begins.
+    """
+    owner = np.flatnonzero(ends > starts); cursor = starts[owner]; limit = ends[owner]; steps = []
+    while len(owner):
+        key, cursor = _varints(data, cursor)
+        wire_type = (key & 7).astype(np.int64); value = np.zeros(len(owner), dtype=np.uint64); after = cursor.copy()
+        has_varint = np.flatnonzero((wire_type == 0) | (wire_type == 2))   # fixed-width payloads are not varints
+        value[has_varint], after[has_varint] = _varints(data, cursor[has_varint])
+        fixed_size = _FIXED_SIZES[wire_type]
+        if (fixed_size < 0).any(): raise ValueError(f"Unsupported protobuf wire type {int(wire_type[fixed_size < 0][0])}")
+        is_bytes = wire_type == 2
+        steps.append((owner, (key >> 3).astype(np.int64), wire_type, value, np.where(is_bytes, after, cursor)))
+        cursor = after + fixed_size + np.where(is_bytes, value, 0).astype(np.int64)
+        if (cursor > limit).any(): raise ValueError("Truncated protobuf message")
+        more = cursor < limit; owner = owner[more]; cursor = cursor[more]; limit = limit[more]
+    if not steps: return (np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.uint64), np.zeros(0, np.int64))
+    return tuple(np.concatenate(parts) for parts in zip(*steps))
+
+def _pick(scan, field, wire_type):
+    """(owner, value, offset) of every occurrence of one field in a scan."""
+    owner, fields, wire_types, values, offsets = scan
+    hit = (fields == field) & (wire_types == wire_type)
+    return owner[hit], values[hit], offsets[hit]
+
+def _submessages(data, scan, field):
+    """(owner of each embedded `field` message, scan of those messages with owners mapped back to the parent's)."""
+    parents, lengths, offsets = _pick(scan, field, 2)
+    owner, fields, wire_types, values, sub_offsets = _scan(data, offsets, offsets + lengths.astype(np.int64))
+    return parents, (parents[owner], fields, wire_types, values, sub_offsets)
+
+def _varint_column(scan, field, n, default, dtype):
+    column = np.full(n, default, dtype=dtype)
+    owner, values, _ = _pick(scan, field, 0); column[owner] = values.astype(dtype)
+    return column
+
+def _fixed_column(data, scan, field, n, dtype):
+    """A float32 (wire type 5) or float64 (wire type 1) column, NaN where absent."""
+    dtype = np.dtype(dtype); column = np.full(n, np.nan, dtype=dtype)
+    owner, _, offsets = _pick(scan, field, 5 if dtype.itemsize == 4 else 1)
+    if len(owner): column[owner] = np.ascontiguousarray(data[offsets[:, None] + np.arange(dtype.itemsize)]).view(dtype.newbyteorder('<'))[:, 0]
+    return column
+
+
+# --- Columns ---
+class VehicleColumns(namedtuple('VehicleColumns', ['feed_timestamp', 'strings', 'vehicle_id', 'label', 'trip_id', 'route_id', 'start_date', 'start_time', 'direction_id',
+                                                   'latitude', 'longitude', 'bearing', 'speed', 'odometer', 'timestamp', 'current_stop_sequence', 'stop_id',
+                                                   'current_status', 'congestion_level', 'occupancy_status'])):
+    """One decoded VehiclePositions feed as parallel NumPy columns, one row per vehicle entity.
+
+    String fields (vehicle_id, label, trip_id, route_id, start_date,
+    start_time, stop_id) are int32 codes into `strings` (NO_CODE when absent).
+    Missing floats are NaN, a missing timestamp is 0 and missing small ints
+    are NO_VALUE.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.vehicle_id)
+
+    def decode_strings(self, codes):
+        """Object array of the strings behind `codes`, with None for NO_CODE."""
+        return self.strings[np.where(codes < 0, len(self.strings) - 1, codes)]
+
+    def to_frame(self):
+        """The vehicles DataFrame the endpoints use (vehicle_id, trip_id, latitude, longitude first), or None if the feed is empty."""
+        if len(self) == 0: return None
+        return pd.DataFrame({'vehicle_id': self.decode_strings(self.vehicle_id), 'trip_id': self.decode_strings(self.trip_id),
+                             'latitude': self.latitude, 'longitude': self.longitude, 'timestamp': self.timestamp, 'bearing': self.bearing,
+                             'speed': self.speed, 'odometer': self.odometer, 'current_stop_sequence': self.current_stop_sequence,
+                             'stop_id': self.decode_strings(self.stop_id), 'current_status': self.current_status,
+                             'congestion_level': self.congestion_level, 'occupancy_status': self.occupancy_status,
+                             'feed_route_id': self.decode_strings(self.route_id), 'direction_id': self.direction_id,
+                             'start_date': self.decode_strings(self.start_date), 'start_time': self.decode_strings(self.start_time),
+                             'label': self.decode_strings(self.label)})
+
+
+# --- Decoder ---
+class VehiclePositionsDecoder:
+    """Decodes VehiclePositions feed bytes into VehicleColumns.
+
+    The string table persists across calls, so a vehicle or trip keeps the
+    same code from one snapshot to the next. It only grows with distinct IDs
+    seen, which the static GTFS bounds. Not thread-safe; give each polling
+    thread its own decoder.
+    """
+
+    def __init__(self):
+        self._codes = {}; self._strings = []
+        self._known = np.zeros(0, dtype='S1'); self._known_codes = np.zeros(0, dtype=np.int32)   # sorted raw IDs seen so far, for vectorized lookup
+        self._string_array = np.array([None], dtype=object)
+
+    def _intern(self, raw):
+        code = self._codes.get(raw)
+        if code is None:
+            code = self._codes[raw] = len(self._strings); self._strings.append(raw.decode('utf-8'))
+        return code
+
+    def _string_column(self, data, scan, field, n, default):
+        """Interned codes of a string field. Each distinct value is looked up once per feed, not once per vehicle."""
+        column = np.full(n, default, dtype=np.int32)
+        owner, lengths, offsets = _pick(scan, field, 2)
+        if len(owner) == 0: return column
+        lengths = lengths.astype(np.int64); width = max(int(lengths.max()), 1); byte_offsets = np.arange(width)
+        window = data[np.minimum(offsets[:, None] + byte_offsets, len(data) - 1)]; window[byte_offsets >= lengths[:, None]] = 0
+        # fixed-width bytes drop trailing NULs, which GTFS text IDs never carry
+        column[owner] = self._lookup(np.ascontiguousarray(window).view(f'S{width}').ravel())
+        return column
+
+    def _lookup(self, raw_ids):
+        """Codes for an array of raw IDs: a binary search against every ID seen so far; only new ones are interned one by one."""
+        if len(self._known):
+            position = np.minimum(np.searchsorted(self._known, raw_ids), len(self._known) - 1)
+            found = self._known[position] == raw_ids; codes = np.where(found, self._known_codes[position], NO_CODE).astype(np.int32)
+        else:
+            found = np.zeros(len(raw_ids), dtype=bool); codes = np.full(len(raw_ids), NO_CODE, dtype=np.int32)
+        if not found.all():
+            new, inverse = np.unique(raw_ids[~found], return_inverse=True)
+            new_codes = np.array([self._intern(raw) for raw in new.tolist()], dtype=np.int32); codes[~found] = new_codes[inverse.ravel()]
+            known = np.concatenate([self._known, new]); order = np.argsort(known, kind='stable')
+            self._known = known[order]; self._known_codes = np.concatenate([self._known_codes, new_codes])[order]
+        return codes
+
+    def decode(self, content):
+        buf = bytes(content); data = np.frombuffer(buf + bytes(_VARINT_WIDTH), dtype=np.uint8)
+        header, entity_starts, entity_ends = _top_level_spans(buf)
+        feed_timestamp = None
+        if header is not None:
+            _, timestamps, _ = _pick(_scan(data, np.array([header[0]]), np.array([header[1]])), _HEADER_TIMESTAMP, 0)
+            if len(timestamps): feed_timestamp = int(timestamps[-1])
+
+        # one row per entity carrying a VehiclePosition, in feed order
+        _, vehicle_lengths, vehicle_offsets = _pick(_scan(data, entity_starts, entity_ends), _ENTITY_VEHICLE, 2)
+        n = len(vehicle_offsets)
+        vp = _scan(data, vehicle_offsets, vehicle_offsets + vehicle_lengths.astype(np.int64))
+        trip_rows, trip = _submessages(data, vp, _VP_TRIP)
+        _, position = _submessages(data, vp, _VP_POSITION)
+        _, descriptor = _submessages(data, vp, _VP_VEHICLE)
+        empty = self._lookup(np.array([b''], dtype='S1'))[0]
+
+        vehicle_id = self._string_column(data, descriptor, _VEHICLE_ID, n, empty)
+        trip_id = np.full(n, NO_CODE, dtype=np.int32); trip_id[trip_rows] = empty   # trip present without trip_id reads as '', as with the generated classes
+        owner, _, _ = _pick(trip, _TRIP_ID, 2); trip_id[owner] = self._string_column(data, trip, _TRIP_ID, n, NO_CODE)[owner]
+        columns = dict(vehicle_id=vehicle_id, label=self._string_column(data, descriptor, _VEHICLE_LABEL, n, NO_CODE),
+                       trip_id=trip_id, route_id=self._string_column(data, trip, _TRIP_ROUTE_ID, n, NO_CODE),
+                       start_date=self._string_column(data, trip, _TRIP_START_DATE, n, NO_CODE), start_time=self._string_column(data, trip, _TRIP_START_TIME, n, NO_CODE),
+                       direction_id=_varint_column(trip, _TRIP_DIRECTION_ID, n, NO_VALUE, np.int16),
+                       latitude=np.nan_to_num(_fixed_column(data, position, _POS_LATITUDE, n, np.float32).astype(np.float64)),
+                       longitude=np.nan_to_num(_fixed_column(data, position, _POS_LONGITUDE, n, np.float32).astype(np.float64)),
+                       bearing=_fixed_column(data, position, _POS_BEARING, n, np.float32), speed=_fixed_column(data, position, _POS_SPEED, n, np.float32),
+                       odometer=_fixed_column(data, position, _POS_ODOMETER, n, np.float64),
+                       timestamp=_varint_column(vp, _VP_TIMESTAMP, n, 0, np.int64), current_stop_sequence=_varint_column(vp, _VP_STOP_SEQUENCE, n, NO_VALUE, np.int32),
+                       stop_id=self._string_column(data, vp, _VP_STOP_ID, n, NO_CODE), current_status=_varint_column(vp, _VP_STATUS, n, IN_TRANSIT_TO, np.int16),
+                       congestion_level=_varint_column(vp, _VP_CONGESTION, n, NO_VALUE, np.int16), occupancy_status=_varint_column(vp, _VP_OCCUPANCY, n, NO_VALUE, np.int16))
+        # the string table is only complete once every string column has been interned
+        if len(self._string_array) != len(self._strings) + 1: self._string_array = np.array(self._strings + [None], dtype=object)
+        return VehicleColumns(feed_timestamp=feed_timestamp, strings=self._string_array, **columns)
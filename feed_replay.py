@@ -0,0 +1,115 @@
+# feed_replay.py
+# Record-and-replay for the GTFS-realtime VehiclePositions feed, so the API
+# can be exercised and benchmarked without the live otd.delhi.gov.in feed.
+#
+#   python feed_replay.py record "$LIVE_API_URL" feed_recordings/ --interval 10
+#   python feed_replay.py serve feed_recordings/ --port 8900 --advance 10
+#
+# then start the API against the replay:
+#
+#   LIVE_API_URL=http://127.0.0.1:8900/VehiclePositions.pb python api.py
+#
+# Recordings are plain <fetched_at_ms>.pb files holding the raw response
+# bodies, so they also feed bench_feed_decode.py directly.
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from feed_decoder import VehiclePositionsDecoder
+
+DEFAULT_RECORDINGS_DIR = 'feed_recordings'
+
+
+# --- Recorder ---
+def record_feed(url, out_dir=DEFAULT_RECORDINGS_DIR, interval=10, count=None, timeout=15):
+    """Polls url every `interval` seconds and saves each changed response body as <fetched_at_ms>.pb."""
+    os.makedirs(out_dir, exist_ok=True)
+    session = requests.Session(); last_digest = None; saved = 0
+    while count is None or saved < count:
+        started = time.time()
+        try:
+            response = session.get(url, timeout=timeout); response.raise_for_status()
+            digest = hashlib.sha256(response.content).digest()
+            if digest != last_digest:
+                columns = VehiclePositionsDecoder().decode(response.content)   # only keep snapshots that parse
+                path = os.path.join(out_dir, f"{int(started * 1000)}.pb")
+                with open(path + '.tmp', 'wb') as f: f.write(response.content)
+                os.replace(path + '.tmp', path)
+                last_digest = digest; saved += 1
+                print(f"Saved {path}: {len(columns)} vehicles, feed timestamp {columns.feed_timestamp}")
+        except Exception as e:
+            print(f"Recording failed, retrying: {e}", file=sys.stderr)
+        time.sleep(max(0.0, interval - (time.time() - started)))
+    return saved
+
+def recorded_snapshots(recordings_dir=DEFAULT_RECORDINGS_DIR):
+    """Recorded .pb paths, oldest first."""
+    return sorted(glob.glob(os.path.join(recordings_dir, '*.pb')), key=lambda path: (len(os.path.basename(path)), os.path.basename(path)))
+
+
+# --- Replay Server ---
+class FeedReplay:
+    """Cycles through recorded snapshots, moving to the next one every `advance` seconds (0 = on every request)."""
+
+    def __init__(self, paths, advance=10):
+        if not paths: raise ValueError("No recorded snapshots to replay")
+        self.snapshots = []
+        for path in paths:
+            with open(path, 'rb') as f: content = f.read()
+            self.snapshots.append((content, '"' + hashlib.sha256(content).hexdigest()[:16] + '"'))
+        self.advance = advance; self.served = 0
+        self._started = time.monotonic(); self._lock = threading.Lock()
+
+    def current(self):
+        """(body, etag) the upstream would return right now."""
+        with self._lock:
+            self.served += 1
+            position = self.served - 1 if self.advance <= 0 else int((time.monotonic() - self._started) // self.advance)
+            return self.snapshots[position % len(self.snapshots)]
+
+def make_replay_handler(replay):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body, etag = replay.current()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304); self.send_header('ETag', etag); self.end_headers(); return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf'); self.send_header('Content-Length', str(len(body))); self.send_header('ETag', etag)
+            self.end_headers(); self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass   # the poller hits this every few seconds
+    return ReplayHandler
+
+def start_replay_server(recordings_dir=DEFAULT_RECORDINGS_DIR, port=8900, advance=10):
+    """Serves the recordings on 127.0.0.1:port in a daemon thread; returns (server, feed URL)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_replay_handler(FeedReplay(recorded_snapshots(recordings_dir), advance)))
+    threading.Thread(target=server.serve_forever, name='feed-replay', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/VehiclePositions.pb"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record or replay the VehiclePositions feed.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record'); record.add_argument('url'); record.add_argument('out_dir', nargs='?', default=DEFAULT_RECORDINGS_DIR)
+    record.add_argument('--interval', type=float, default=10); record.add_argument('--count', type=int)
+    serve = commands.add_parser('serve'); serve.add_argument('recordings_dir', nargs='?', default=DEFAULT_RECORDINGS_DIR)
+    serve.add_argument('--port', type=int, default=8900); serve.add_argument('--advance', type=float, default=10)
+    args = parser.parse_args()
+    if args.command == 'record':
+        record_feed(args.url, args.out_dir, args.interval, args.count)
+    else:
+        server, url = start_replay_server(args.recordings_dir, args.port, args.advance)
+        print(f"Replaying {len(recorded_snapshots(args.recordings_dir))} snapshots at {url}")
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
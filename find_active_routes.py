@@ -1,20 +1,20 @@
 # find_active_routes.py
 
-import pandas as pd
 # Make sure to copy your fetch_live_bus_data function into this file
 from live_predictor import fetch_live_bus_data 
+from gtfs_cache import load_gtfs_store
 
 print("Finding all currently active routes...")
 
-# Load the trips file to map trip_id to route_id
-trips_df = pd.read_csv('trips.csv')
+# Load the compiled GTFS cache to map trip_id to route_id
+trip_index = load_gtfs_store().trip_index
 
 # Get all live bus data
 live_buses_df = fetch_live_bus_data()
 
 if live_buses_df is not None and not live_buses_df.empty:
-    # Merge with trips to find the route for each bus
-    live_buses_with_routes = pd.merge(live_buses_df.dropna(subset=['trip_id']), trips_df, on='trip_id')
+    # Look up the route for each bus's trip
+    live_buses_with_routes = trip_index.with_route_ids(live_buses_df)
     
     # Get a list of unique, active route IDs
     active_routes = live_buses_with_routes['route_id'].unique()
@@ -0,0 +1,169 @@
+# gtfs_cache.py
+# One-time compile of the static GTFS CSVs, plus the derived indexes from
+# gtfs_index.py, into plain .npy files that every API worker memory-maps at
+# startup. The pages are shared by all processes on the machine and startup
+# skips the CSV parsing and merges entirely.
+#
+# Run `python gtfs_cache.py` after updating the CSVs, or let the first API
+# worker compile it. The cache is invalidated by a hash of the source files.
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from gtfs_index import DepartureTimetable, RoutePatternIndex, TransitNetwork, TripIndex
+
+FORMAT_VERSION = 5
+SOURCE_FILES = ('stops.csv', 'trips.csv', 'stop_times.csv', 'routes.csv')
+DEFAULT_CACHE_DIR = 'gtfs_cache'
+STOP_COLUMNS = ['stop_id', 'stop_name', 'stop_lat', 'stop_lon']
+ROUTE_COLUMNS = ['route_id', 'route_short_name']
+INDEX_TYPES = {'trips': TripIndex, 'patterns': RoutePatternIndex, 'timetable': DepartureTimetable, 'network': TransitNetwork}
+
+GtfsStore = namedtuple('GtfsStore', ['stops_df', 'routes_df', 'trip_index', 'route_pattern_index', 'departure_timetable', 'transit_network'])
+
+
+# --- Building from CSV ---
+def build_gtfs_store(data_dir='.'):
+    """Reads the GTFS CSVs and builds every static index in memory (the slow path)."""
+    stops_df = pd.read_csv(os.path.join(data_dir, 'stops.csv'))
+    trips_df = pd.read_csv(os.path.join(data_dir, 'trips.csv'))
+    routes_df = pd.read_csv(os.path.join(data_dir, 'routes.csv'))
+    route_map = pd.merge(pd.merge(pd.read_csv(os.path.join(data_dir, 'stop_times.csv')), trips_df, on='trip_id'), stops_df, on='stop_id')
+    trip_index = TripIndex.from_route_map(route_map); del route_map
+    return GtfsStore(stops_df=stops_df[STOP_COLUMNS].reset_index(drop=True), routes_df=routes_df[ROUTE_COLUMNS].reset_index(drop=True), trip_index=trip_index,
+                     route_pattern_index=RoutePatternIndex.from_trip_index(trip_index), departure_timetable=DepartureTimetable.from_trip_index(trip_index),
+                     transit_network=TransitNetwork.from_trip_index(trip_index))
+
+
+# --- Array (de)serialisation ---
+def _is_text(values):
+    # pandas 3 reads CSV text as its own str dtype rather than object
+    return values.dtype == object or pd.api.types.is_string_dtype(values)
+
+def _storable(values):
+    """Object (string) columns become fixed-width unicode so they can be memory-mapped without pickle."""
+    values = np.asarray(values)
+    return values.astype(np.str_) if _is_text(values) else values
+
+def _store_to_arrays(store):
+    arrays = {}
+    for prefix, table in (('stops', store.stops_df), ('routes', store.routes_df)):
+        for column in table.columns:
+            values = table[column]
+            arrays[f'{prefix}.{column}'] = _storable(values.fillna('') if _is_text(values) else values)
+    for prefix, index in (('trips', store.trip_index), ('patterns', store.route_pattern_index), ('timetable', store.departure_timetable), ('network', store.transit_network)):
+        arrays.update({f'{prefix}.{name}': _storable(values) for name, values in index.to_arrays().items()})
+    return arrays
+
+def _table_from_arrays(arrays, prefix, columns):
+    data = {}
+    for column in columns:
+        values = arrays[f'{prefix}.{column}']
+        # Blank strings were missing values (e.g. empty route_short_name) before compiling
+        data[column] = pd.Series(values, dtype=object).where(values != '', None) if _is_text(values) else values
+    return pd.DataFrame(data)
+
+def _store_from_arrays(arrays):
+    indexes = {prefix: index_type.from_arrays({name[len(prefix) + 1:]: values for name, values in arrays.items() if name.startswith(prefix + '.')})
+               for prefix, index_type in INDEX_TYPES.items()}
+    return GtfsStore(stops_df=_table_from_arrays(arrays, 'stops', STOP_COLUMNS), routes_df=_table_from_arrays(arrays, 'routes', ROUTE_COLUMNS),
+                     trip_index=indexes['trips'], route_pattern_index=indexes['patterns'], departure_timetable=indexes['timetable'], transit_network=indexes['network'])
+
+
+# --- Source fingerprints ---
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+def _source_fingerprints(data_dir):
+    fingerprints = {}
+    for name in SOURCE_FILES:
+        stat = os.stat(os.path.join(data_dir, name))
+        fingerprints[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _sha256(os.path.join(data_dir, name))}
+    return fingerprints
+
+def _sources_match(manifest, data_dir):
+    """(match, touched): match is True if the CSVs are the ones the cache was compiled from. Size+mtime
+    is the fast path; a changed mtime falls back to hashing so a touched-but-identical file does not
+    force a rebuild, and its new mtime is recorded in the manifest (touched) so the next start skips
+    the hash. Missing CSVs are allowed, so a deployment can ship just the compiled cache."""
+    touched = False
+    for name, recorded in manifest['sources'].items():
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path): continue
+        stat = os.stat(path)
+        if stat.st_size == recorded['size'] and stat.st_mtime_ns == recorded['mtime_ns']: continue
+        if stat.st_size != recorded['size'] or _sha256(path) != recorded['sha256']: return False, False
+        recorded['mtime_ns'] = stat.st_mtime_ns; touched = True
+    return True, touched
+
+def _write_manifest(cache_dir, manifest):
+    # written next to the real one and renamed over it, so readers never see a partial file
+    fd, manifest_tmp = tempfile.mkstemp(dir=cache_dir, prefix='.manifest-')
+    with os.fdopen(fd, 'w') as f: json.dump(manifest, f, indent=2)
+    os.replace(manifest_tmp, os.path.join(cache_dir, 'manifest.json'))
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f: manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if manifest.get('format_version') == FORMAT_VERSION else None
+
+
+# --- Compile / load ---
+def compile_gtfs_cache(data_dir='.', cache_dir=DEFAULT_CACHE_DIR):
+    """Builds every index from the CSVs and writes them as .npy files plus a manifest. Returns the manifest."""
+    started = time.time()
+    sources = _source_fingerprints(data_dir)
+    arrays = _store_to_arrays(build_gtfs_store(data_dir))
+    build = hashlib.sha256(json.dumps([FORMAT_VERSION, sorted((name, f['sha256']) for name, f in sources.items())]).encode()).hexdigest()[:16]
+
+    # Arrays go to a staging dir that is renamed into place, so concurrent workers never see a partial build
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix='.staging-')
+    for name, values in arrays.items(): np.save(os.path.join(staging, name + '.npy'), values, allow_pickle=False)
+    try:
+        os.replace(staging, os.path.join(cache_dir, build))
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)   # another worker already published this build
+
+    manifest = {'format_version': FORMAT_VERSION, 'build': build, 'sources': sources, 'arrays': sorted(arrays), 'compiled_at': time.time()}
+    _write_manifest(cache_dir, manifest)
+    for entry in os.listdir(cache_dir):
+        if entry != build and os.path.isdir(os.path.join(cache_dir, entry)) and not entry.startswith('.'):
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+    print(f"Compiled GTFS cache {build} ({len(arrays)} arrays) in {time.time() - started:.1f}s.")
+    return manifest
+
+def load_gtfs_store(data_dir='.', cache_dir=DEFAULT_CACHE_DIR):
+    """Memory-maps the compiled GTFS cache, compiling it first if it is missing or stale."""
+    manifest = _read_manifest(cache_dir)
+    match, touched = (False, False) if manifest is None else _sources_match(manifest, data_dir)
+    if not match:
+        print("GTFS cache is missing or stale, compiling from CSV...")
+        manifest = compile_gtfs_cache(data_dir, cache_dir)
+    elif touched:
+        try:
+            _write_manifest(cache_dir, manifest)
+        except OSError as e:   # e.g. a read-only cache; it still loads, the CSVs are just hashed again next start
+            print(f"Could not record the touched CSVs' new mtimes in the GTFS cache manifest: {e}", file=sys.stderr)
+    build_dir = os.path.join(cache_dir, manifest['build'])
+    arrays = {name: np.load(os.path.join(build_dir, name + '.npy'), mmap_mode='r', allow_pickle=False) for name in manifest['arrays']}
+    return _store_from_arrays(arrays)
+
+
+# --- Main execution block ---
+if __name__ == '__main__':
+    compile_gtfs_cache(*sys.argv[1:3])
@@ -0,0 +1,474 @@
+# gtfs_index.py
+# Read-only indexes over the static GTFS tables. They are built once at
+# startup so the request path never has to filter the full stop_times table.
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371
+SECONDS_PER_DAY = 24 * 3600
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+MISSING_TIME = -1
+
+
+# --- Helpers ---
+def haversine_km_vectorized(lat, lon, lats, lons):
+    """Great-circle distance in km from one or many points to arrays of points."""
+    lat_rad = np.radians(lat); lon_rad = np.radians(lon); lats_rad = np.radians(lats); lons_rad = np.radians(lons)
+    a = np.sin((lats_rad - lat_rad) / 2)**2 + np.cos(lat_rad) * np.cos(lats_rad) * np.sin((lons_rad - lon_rad) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def gtfs_time_to_seconds(times):
+    """Converts GTFS 'HH:MM:SS' strings to int32 seconds since the start of the service day.
+
+    Times past 24:00:00 are kept as-is (e.g. '25:10:00' -> 90600); blanks become MISSING_TIME.
+    """
+    parts = pd.Series(times, dtype='object').astype('string').str.strip().str.extract(r'^(\d+):(\d{1,2}):(\d{1,2})$')
+    seconds = pd.to_numeric(parts[0]) * 3600 + pd.to_numeric(parts[1]) * 60 + pd.to_numeric(parts[2])
+    return seconds.fillna(MISSING_TIME).to_numpy(dtype=np.int32)
+
+def expand_row_ranges(first_rows, end_rows):
+    """Flattens per-item row ranges [first, end) into (rows, counts, group_starts).
+
+    rows holds every covered row, grouped contiguously by item; item i's run
+    starts at rows[group_starts[i]] and has counts[i] entries.
+    """
+    first_rows = np.asarray(first_rows, dtype=np.int64)
+    counts = np.maximum(np.asarray(end_rows, dtype=np.int64) - first_rows, 0)
+    group_starts = np.zeros(len(counts), dtype=np.int64); np.cumsum(counts[:-1], out=group_starts[1:])
+    rows = np.repeat(first_rows, counts) + np.arange(int(counts.sum())) - np.repeat(group_starts, counts)
+    return rows, counts, group_starts
+
+
+# --- Array-backed indexes ---
+class ArrayIndex:
+    """Base for indexes fully described by the named NumPy arrays in ARRAYS.
+
+    The constructor takes exactly those arrays, so an index can be written to
+    and memory-mapped back from the compiled cache (see gtfs_cache.py).
+    """
+    ARRAYS = ()
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+
+# --- Stop locations ---
+class StopSpatialIndex:
+    """KD-tree over stop coordinates for radius and k-nearest queries.
+
+    Stops are projected onto a flat km grid centred on the network; the tree
+    only proposes candidates, and final distances are exact haversine so the
+    results are sorted by true distance.
+    """
+
+    PROJECTION_SLACK = 1.05   # covers equirectangular error across a city-sized network
+
+    def __init__(self, stop_lats, stop_lons):
+        self.stop_lats = np.asarray(stop_lats, dtype=np.float64); self.stop_lons = np.asarray(stop_lons, dtype=np.float64)
+        self._origin_lat = float(np.mean(self.stop_lats)) if len(self.stop_lats) else 0.0
+        self._lon_scale = np.cos(np.radians(self._origin_lat)) * KM_PER_DEGREE
+        self._tree = cKDTree(self._project(self.stop_lats, self.stop_lons))
+
+    def __len__(self):
+        return len(self.stop_lats)
+
+    def _project(self, lats, lons):
+        return np.column_stack((np.asarray(lons, dtype=np.float64) * self._lon_scale, (np.asarray(lats, dtype=np.float64) - self._origin_lat) * KM_PER_DEGREE))
+
+    def _sorted_within(self, lat, lon, candidates, radius_km=None):
+        candidates = np.asarray(candidates, dtype=np.int64)
+        distances = haversine_km_vectorized(lat, lon, self.stop_lats[candidates], self.stop_lons[candidates])
+        if radius_km is not None:
+            within = distances <= radius_km; candidates, distances = candidates[within], distances[within]
+        order = np.argsort(distances, kind='stable')
+        return candidates[order], distances[order]
+
+    def query_radius(self, lat, lon, radius_km):
+        """Positions of stops within radius_km of the point and their distances, nearest first."""
+        candidates = self._tree.query_ball_point(self._project([lat], [lon])[0], r=radius_km * self.PROJECTION_SLACK)
+        return self._sorted_within(lat, lon, candidates, radius_km)
+
+    def query_nearest(self, lat, lon, k=1):
+        """Positions of the k nearest stops and their distances, nearest first."""
+        k = min(k, len(self))
+        if k == 0: return np.zeros(0, dtype=np.int64), np.zeros(0)
+        _, candidates = self._tree.query(self._project([lat], [lon])[0], k=min(len(self), k + 2))
+        positions, distances = self._sorted_within(lat, lon, np.atleast_1d(candidates))
+        return positions[:k], distances[:k]
+
+    def query_radius_batch(self, lats, lons, radius_km):
+        """query_radius for many points at once; one (positions, distances) pair per point."""
+        candidate_lists = self._tree.query_ball_point(self._project(lats, lons), r=radius_km * self.PROJECTION_SLACK)
+        return [self._sorted_within(lat, lon, candidates, radius_km) for lat, lon, candidates in zip(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64), candidate_lists)]
+
+
+# --- Per-trip stop sequences ---
+class TripIndex(ArrayIndex):
+    """Every trip's stops as one contiguous, stop_sequence-ordered run inside flat NumPy arrays.
+
+    Rows for trip i live in [offsets[i], offsets[i + 1]), so a trip lookup is a
+    dict hit plus a slice instead of a boolean scan of route_map. Stops are
+    interned: a row holds an int32 code into the per-stop tables
+    (stop_id_table is sorted, with one lat/lon per stop), so every per-row
+    array is a 4-byte integer and stop comparisons are integer comparisons.
+    """
+
+    ARRAYS = ('trip_ids', 'trip_route_ids', 'offsets', 'stop_codes', 'stop_sequences', 'arrival_seconds', 'departure_seconds', 'stop_id_table', 'stop_lat_table', 'stop_lon_table')
+
+    def __init__(self, trip_ids, trip_route_ids, offsets, stop_codes, stop_sequences, arrival_seconds, departure_seconds, stop_id_table, stop_lat_table, stop_lon_table):
+        self.trip_ids = trip_ids; self.trip_route_ids = trip_route_ids; self.offsets = offsets
+        self.stop_codes = stop_codes; self.stop_sequences = stop_sequences
+        self.arrival_seconds = arrival_seconds; self.departure_seconds = departure_seconds
+        self.stop_id_table = stop_id_table; self.stop_lat_table = stop_lat_table; self.stop_lon_table = stop_lon_table
+        self._trip_position = {trip_id: i for i, trip_id in enumerate(trip_ids.tolist())}
+
+    @classmethod
+    def from_route_map(cls, route_map):
+        frame = route_map.sort_values(['trip_id', 'stop_sequence'], kind='mergesort')
+        trip_codes, trip_ids = pd.factorize(frame['trip_id'], sort=True)
+        offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64); np.cumsum(np.bincount(trip_codes, minlength=len(trip_ids)), out=offsets[1:])
+        stop_id_table, first_rows, stop_codes = np.unique(frame['stop_id'].to_numpy(), return_index=True, return_inverse=True)
+        return cls(trip_ids=np.asarray(trip_ids), trip_route_ids=frame['route_id'].to_numpy()[offsets[:-1]], offsets=offsets,
+                   stop_codes=stop_codes.astype(np.int32), stop_sequences=frame['stop_sequence'].to_numpy(dtype=np.int32),
+                   arrival_seconds=gtfs_time_to_seconds(frame['arrival_time']), departure_seconds=gtfs_time_to_seconds(frame['departure_time']),
+                   stop_id_table=stop_id_table, stop_lat_table=frame['stop_lat'].to_numpy(dtype=np.float64)[first_rows], stop_lon_table=frame['stop_lon'].to_numpy(dtype=np.float64)[first_rows])
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    def trip_position(self, trip_id):
+        return self._trip_position.get(trip_id)
+
+    def stop_code(self, stop_id):
+        """Interned code of a stop_id, or -1 if no trip serves it."""
+        if len(self.stop_id_table) == 0: return -1
+        code = int(np.searchsorted(self.stop_id_table, stop_id))
+        return code if code < len(self.stop_id_table) and self.stop_id_table[code] == stop_id else -1
+
+    def stop_codes_of(self, stop_ids):
+        """Interned codes of many stop_ids at once; -1 for stops no trip serves."""
+        if len(stop_ids) == 0 or len(self.stop_id_table) == 0: return np.full(len(stop_ids), -1, dtype=np.int32)
+        stop_ids = np.asarray(stop_ids); codes = np.minimum(np.searchsorted(self.stop_id_table, stop_ids), len(self.stop_id_table) - 1)
+        return np.where(self.stop_id_table[codes] == stop_ids, codes, -1).astype(np.int32)
+
+    def stop_ids_at(self, rows):
+        return self.stop_id_table[self.stop_codes[rows]]
+
+    def stop_coords_at(self, rows):
+        """(lats, lons) of the stops at the given rows."""
+        codes = self.stop_codes[rows]
+        return self.stop_lat_table[codes], self.stop_lon_table[codes]
+
+    def trip_positions(self, trip_ids):
+        """Positions of many trips at once; -1 for unknown trips."""
+        return np.fromiter((self._trip_position.get(trip_id, -1) for trip_id in trip_ids), dtype=np.int64, count=len(trip_ids))
+
+    def with_route_ids(self, buses_df):
+        """Rows of a live-vehicle frame whose trip is known, with that trip's route_id attached."""
+        buses = buses_df.dropna(subset=['trip_id'])
+        positions = self.trip_positions(buses['trip_id'].tolist()); known = positions >= 0
+        return buses[known].assign(route_id=self.trip_route_ids[positions[known]]).reset_index(drop=True)
+
+    def trip_rows(self, trip_id):
+        """Returns the (start, end) row range of a trip, or None if the trip is unknown."""
+        pos = self._trip_position.get(trip_id)
+        if pos is None: return None
+        return int(self.offsets[pos]), int(self.offsets[pos + 1])
+
+    def route_for_trip(self, trip_id):
+        pos = self._trip_position.get(trip_id)
+        return None if pos is None else self.trip_route_ids[pos]
+
+    def find_stop_row(self, trip_id, stop_id, after_row=None):
+        """Row of the first visit to stop_id on the trip (strictly after after_row if given), or None."""
+        rows = self.trip_rows(trip_id)
+        if rows is None: return None
+        start, end = rows
+        if after_row is not None: start = max(start, after_row + 1)
+        code = self.stop_code(stop_id)
+        if code < 0: return None
+        hits = np.flatnonzero(self.stop_codes[start:end] == code)
+        return None if len(hits) == 0 else start + int(hits[0])
+
+    def stop_record(self, row, stop_names=None):
+        """Plain dict for one stop row, shaped like the route_map rows the endpoints used to read."""
+        code = self.stop_codes[row]; stop_id = self.stop_id_table[code]
+        return {'stop_id': stop_id, 'stop_sequence': int(self.stop_sequences[row]),
+                'stop_lat': float(self.stop_lat_table[code]), 'stop_lon': float(self.stop_lon_table[code]),
+                'stop_name': None if stop_names is None else stop_names.get(stop_id),
+                'arrival_seconds': int(self.arrival_seconds[row]), 'departure_seconds': int(self.departure_seconds[row])}
+
+    def locate_vehicles(self, trip_ids, lats, lons, from_rows=None, max_segments=8):
+        """Snaps every bus onto its trip's stop polyline in one vectorized pass.
+
+        Each bus is projected onto all segments of its trip (in a local
+        equirectangular frame) and the closest segment wins, so buses that have
+        passed their nearest stop, or run loop routes, land on the right leg.
+        Returns (last_rows, progress, off_route_km): the segment for bus i runs
+        from row last_rows[i] to last_rows[i] + 1 and progress[i] is the
+        fraction of it already covered. Unknown trips (or trips with fewer than
+        two stops) get last_rows == -1.
+
+        With from_rows, a bus whose from_rows entry is a row of its trip is only
+        matched against the max_segments segments starting there (the segment it
+        was last seen on and the ones ahead); -1 scans the whole trip.
+        """
+        lats = np.asarray(lats, dtype=np.float64); lons = np.asarray(lons, dtype=np.float64); n = len(lats)
+        last_rows = np.full(n, -1, dtype=np.int64); progress = np.zeros(n); off_route_km = np.full(n, np.nan)
+        positions = self.trip_positions(list(trip_ids))
+        buses = np.flatnonzero(positions >= 0)
+        first_rows = self.offsets[positions[buses]]; segment_counts = self.offsets[positions[buses] + 1] - first_rows - 1
+        if from_rows is not None:
+            starts = np.asarray(from_rows, dtype=np.int64)[buses]
+            windowed = (starts >= first_rows) & (starts < first_rows + segment_counts)
+            segment_counts = np.where(windowed, np.minimum(first_rows + segment_counts - starts, max_segments), segment_counts)
+            first_rows = np.where(windowed, starts, first_rows)
+        has_segments = segment_counts > 0
+        buses, first_rows, segment_counts = buses[has_segments], first_rows[has_segments], segment_counts[has_segments]
+        if len(buses) == 0: return last_rows, progress, off_route_km
+
+        # One entry per (bus, segment) pair, grouped contiguously by bus
+        a_rows, _, group_starts = expand_row_ranges(first_rows, first_rows + segment_counts)
+        owner = np.repeat(np.arange(len(buses)), segment_counts)
+        bus_lat = lats[buses][owner]; bus_lon = lons[buses][owner]; lon_scale = np.cos(np.radians(bus_lat)) * KM_PER_DEGREE
+
+        # Segment endpoints relative to the bus, in km; the bus sits at the origin
+        a_lats, a_lons = self.stop_coords_at(a_rows); b_lats, b_lons = self.stop_coords_at(a_rows + 1)
+        ax = (a_lons - bus_lon) * lon_scale; ay = (a_lats - bus_lat) * KM_PER_DEGREE
+        dx = (b_lons - bus_lon) * lon_scale - ax; dy = (b_lats - bus_lat) * KM_PER_DEGREE - ay
+        length_sq = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(length_sq > 0, length_sq, 1.0), 0.0, 1.0)
+        distance_sq = (ax + t * dx)**2 + (ay + t * dy)**2
+
+        best = np.lexsort((distance_sq, owner))[group_starts]
+        last_rows[buses] = a_rows[best]; progress[buses] = t[best]; off_route_km[buses] = np.sqrt(distance_sq[best])
+        return last_rows, progress, off_route_km
+
+
+# --- Route patterns ---
+class RoutePatternIndex(ArrayIndex):
+    """Distinct stop sequences of each route ("patterns") with per-stop postings.
+
+    Trips of a route that visit the same stops in the same order share one
+    pattern. For every stop we keep the (pattern, position) pairs where it
+    occurs, so "which routes go from any of stops A to any of stops B, in
+    order" is answered by intersecting posting lists instead of joining
+    stop_times against itself. Stops are TripIndex stop codes.
+    """
+
+    ARRAYS = ('pattern_route_ids', 'pattern_offsets', 'pattern_stop_codes', 'pattern_trip_positions', 'trip_patterns', 'posting_stop_codes', 'posting_patterns', 'posting_positions')
+
+    def __init__(self, pattern_route_ids, pattern_offsets, pattern_stop_codes, pattern_trip_positions, trip_patterns, posting_stop_codes, posting_patterns, posting_positions):
+        self.pattern_route_ids = pattern_route_ids; self.pattern_offsets = pattern_offsets; self.pattern_stop_codes = pattern_stop_codes
+        self.pattern_trip_positions = pattern_trip_positions; self.trip_patterns = trip_patterns
+        self.posting_stop_codes = posting_stop_codes; self.posting_patterns = posting_patterns; self.posting_positions = posting_positions
+
+    @classmethod
+    def from_trip_index(cls, trip_index):
+        pattern_ids = {}; route_ids = []; stop_runs = []; representative_trips = []
+        trip_patterns = np.empty(len(trip_index), dtype=np.int64)
+        for pos in range(len(trip_index)):
+            run = trip_index.stop_codes[trip_index.offsets[pos]:trip_index.offsets[pos + 1]]
+            key = (trip_index.trip_route_ids[pos], run.tobytes())
+            pattern = pattern_ids.get(key)
+            if pattern is None:
+                pattern = pattern_ids[key] = len(route_ids)
+                route_ids.append(key[0]); stop_runs.append(run); representative_trips.append(pos)
+            trip_patterns[pos] = pattern
+        pattern_offsets = np.zeros(len(stop_runs) + 1, dtype=np.int64); np.cumsum([len(run) for run in stop_runs], out=pattern_offsets[1:])
+        pattern_stop_codes = np.concatenate(stop_runs) if stop_runs else trip_index.stop_codes[:0]
+
+        # Postings: every (pattern, position) entry, sorted by stop
+        run_lengths = np.diff(pattern_offsets)
+        entry_patterns = np.repeat(np.arange(len(route_ids)), run_lengths)
+        entry_positions = np.arange(len(pattern_stop_codes)) - np.repeat(pattern_offsets[:-1], run_lengths)
+        order = np.argsort(pattern_stop_codes, kind='stable')
+        return cls(pattern_route_ids=np.asarray(route_ids), pattern_offsets=pattern_offsets, pattern_stop_codes=pattern_stop_codes,
+                   pattern_trip_positions=np.asarray(representative_trips, dtype=np.int64), trip_patterns=trip_patterns,
+                   posting_stop_codes=pattern_stop_codes[order], posting_patterns=entry_patterns[order], posting_positions=entry_positions[order])
+
+    def __len__(self):
+        return len(self.pattern_route_ids)
+
+    def _posting_entries(self, stop_codes):
+        stop_codes = np.asarray(stop_codes, dtype=np.int64)   # unknown stops (-1) have no postings
+        entries, _, _ = expand_row_ranges(np.searchsorted(self.posting_stop_codes, stop_codes, side='left'), np.searchsorted(self.posting_stop_codes, stop_codes, side='right'))
+        return entries
+
+    def connecting_patterns(self, from_stop_codes, to_stop_codes):
+        """(pattern, from_stop_code, to_stop_code) for every pattern that visits a from-stop before a to-stop.
+
+        Results are grouped by pattern and follow the order of from_stop_codes
+        within a pattern.
+        """
+        start_entries = self._posting_entries(from_stop_codes); end_entries = self._posting_entries(to_stop_codes)
+        common = np.intersect1d(self.posting_patterns[start_entries], self.posting_patterns[end_entries])
+        if len(common) == 0: return []
+        start_entries = start_entries[np.isin(self.posting_patterns[start_entries], common)]; end_entries = end_entries[np.isin(self.posting_patterns[end_entries], common)]
+        start_entries = start_entries[np.argsort(self.posting_patterns[start_entries], kind='stable')]; end_entries = end_entries[np.argsort(self.posting_patterns[end_entries], kind='stable')]
+        start_patterns = self.posting_patterns[start_entries]; end_patterns = self.posting_patterns[end_entries]
+        start_bounds = np.searchsorted(start_patterns, common, side='left'), np.searchsorted(start_patterns, common, side='right')
+        end_bounds = np.searchsorted(end_patterns, common, side='left'), np.searchsorted(end_patterns, common, side='right')
+
+        connections = []
+        for i, pattern in enumerate(common.tolist()):
+            starts = start_entries[start_bounds[0][i]:start_bounds[1][i]]; ends = end_entries[end_bounds[0][i]:end_bounds[1][i]]
+            in_order = self.posting_positions[starts][:, None] < self.posting_positions[ends][None, :]
+            for a, b in zip(*np.nonzero(in_order)):
+                connections.append((pattern, int(self.posting_stop_codes[starts[a]]), int(self.posting_stop_codes[ends[b]])))
+        return connections
+
+
+# --- Departure timetable ---
+class DepartureTimetable(ArrayIndex):
+    """Scheduled departures per (route, stop code) across every trip of the route, as sorted int seconds.
+
+    GTFS times past 24:00 belong to the previous service day, so a lookup at
+    00:30 also sees yesterday's 24:40 departure, and when today's service is
+    over the next departures roll into tomorrow.
+    """
+
+    ARRAYS = ('key_route_ids', 'key_stop_codes', 'offsets', 'departure_seconds')
+
+    def __init__(self, key_route_ids, key_stop_codes, offsets, departure_seconds):
+        self.key_route_ids = key_route_ids; self.key_stop_codes = key_stop_codes; self.offsets = offsets
+        self.departure_seconds = departure_seconds
+        self._ranges = {key: (int(offsets[i]), int(offsets[i + 1])) for i, key in enumerate(zip(key_route_ids.tolist(), key_stop_codes.tolist()))}
+
+    @classmethod
+    def from_trip_index(cls, trip_index):
+        counts = np.diff(trip_index.offsets)
+        frame = pd.DataFrame({'route_id': np.repeat(trip_index.trip_route_ids, counts), 'stop_code': trip_index.stop_codes,
+                              'departure_seconds': trip_index.departure_seconds})
+        frame = frame[frame['departure_seconds'] != MISSING_TIME].sort_values(['route_id', 'stop_code', 'departure_seconds'], kind='mergesort')
+        route_ids = frame['route_id'].to_numpy(); stop_codes = frame['stop_code'].to_numpy()
+        boundaries = np.flatnonzero((route_ids[1:] != route_ids[:-1]) | (stop_codes[1:] != stop_codes[:-1])) + 1
+        starts = np.concatenate(([0], boundaries)) if len(frame) else np.zeros(0, dtype=np.int64)
+        offsets = np.append(starts, len(frame)).astype(np.int64)
+        return cls(key_route_ids=route_ids[starts], key_stop_codes=stop_codes[starts], offsets=offsets,
+                   departure_seconds=frame['departure_seconds'].to_numpy(dtype=np.int32))
+
+    def __len__(self):
+        return len(self.key_route_ids)
+
+    def next_departures(self, route_id, stop_code, after_seconds, n=1):
+        """The next n departures at or after after_seconds (seconds since today's midnight).
+
+        Returns seconds since today's midnight; times from yesterday's service
+        are shifted down a day, tomorrow's up a day.
+        """
+        bounds = self._ranges.get((route_id, stop_code))
+        if bounds is None: return np.zeros(0, dtype=np.int64)
+        times = self.departure_seconds[bounds[0]:bounds[1]].astype(np.int64)
+        from_yesterday = np.searchsorted(times, after_seconds + SECONDS_PER_DAY, side='left')
+        from_today = np.searchsorted(times, after_seconds, side='left')
+        seconds = np.concatenate((times[from_yesterday:from_yesterday + n] - SECONDS_PER_DAY, times[from_today:from_today + n], times[:n] + SECONDS_PER_DAY))
+        return np.sort(seconds)[:n]
+
+
+# --- Transit network for journey planning ---
+class TransitNetwork(ArrayIndex):
+    """Compact timetable arrays for round-based (RAPTOR) journey planning.
+
+    Stops are renumbered densely: stop k is stop_ids[k]. Trips of a route that
+    visit the same stops in the same order and never overtake each other form
+    a pattern, its trips sorted by departure. Every (pattern, position) pair
+    is a "column" holding that stop's times for all of the pattern's trips:
+    trip j of the pattern is at column_departures[column_offsets[c] + j], so a
+    column is sorted and finding the first catchable trip is a binary search.
+    Walking transfers between stops within transfer_radius_km are kept per
+    stop in transfer_offsets / transfer_stops / transfer_seconds.
+    """
+
+    ARRAYS = ('stop_ids', 'stop_lats', 'stop_lons', 'pattern_route_ids', 'pattern_offsets', 'pattern_stops', 'pattern_trip_offsets', 'pattern_trips',
+              'column_offsets', 'column_departures', 'column_arrivals', 'stop_column_offsets', 'stop_columns', 'transfer_offsets', 'transfer_stops', 'transfer_seconds')
+    WALK_SECONDS_PER_KM = 3600 / 4.5 * 1.3   # 4.5 km/h, with streets ~30% longer than the straight line
+
+    def __init__(self, stop_ids, stop_lats, stop_lons, pattern_route_ids, pattern_offsets, pattern_stops, pattern_trip_offsets, pattern_trips,
+                 column_offsets, column_departures, column_arrivals, stop_column_offsets, stop_columns, transfer_offsets, transfer_stops, transfer_seconds):
+        self.stop_ids = stop_ids; self.stop_lats = stop_lats; self.stop_lons = stop_lons
+        self.pattern_route_ids = pattern_route_ids; self.pattern_offsets = pattern_offsets; self.pattern_stops = pattern_stops
+        self.pattern_trip_offsets = pattern_trip_offsets; self.pattern_trips = pattern_trips
+        self.column_offsets = column_offsets; self.column_departures = column_departures; self.column_arrivals = column_arrivals
+        self.stop_column_offsets = stop_column_offsets; self.stop_columns = stop_columns
+        self.transfer_offsets = transfer_offsets; self.transfer_stops = transfer_stops; self.transfer_seconds = transfer_seconds
+        lengths = np.diff(pattern_offsets)
+        self.column_patterns = np.repeat(np.arange(len(pattern_route_ids)), lengths)
+        self.column_positions = np.arange(len(pattern_stops)) - np.repeat(pattern_offsets[:-1], lengths)
+        self.max_pattern_length = int(lengths.max()) if len(lengths) else 0
+        self.max_pattern_trips = int(np.diff(pattern_trip_offsets).max()) + 1 if len(lengths) else 1
+
+    @classmethod
+    def from_trip_index(cls, trip_index, transfer_radius_km=0.4):
+        stop_ids = trip_index.stop_id_table; row_stops = trip_index.stop_codes.astype(np.int64)
+        arrivals = trip_index.arrival_seconds.astype(np.int64); departures = trip_index.departure_seconds.astype(np.int64)
+        arrivals, departures = np.where(arrivals == MISSING_TIME, departures, arrivals), np.where(departures == MISSING_TIME, arrivals, departures)
+        counts = np.diff(trip_index.offsets)
+        untimed_rows = np.bincount(np.repeat(np.arange(len(trip_index)), counts), weights=departures == MISSING_TIME, minlength=len(trip_index))
+
+        # Group trips by (route, stop run), then split each group into runs of trips that never overtake each other
+        groups = {}
+        for pos in np.flatnonzero((untimed_rows == 0) & (counts >= 2)).tolist():
+            key = (trip_index.trip_route_ids[pos], row_stops[trip_index.offsets[pos]:trip_index.offsets[pos + 1]].tobytes())
+            groups.setdefault(key, []).append(pos)
+        patterns = []
+        for (route_id, _), trips in groups.items():
+            trips.sort(key=lambda pos: (departures[trip_index.offsets[pos]], arrivals[trip_index.offsets[pos + 1] - 1]))
+            fifo_runs = []   # [trips, last trip's departures, last trip's arrivals]
+            for pos in trips:
+                rows = slice(trip_index.offsets[pos], trip_index.offsets[pos + 1])
+                for run in fifo_runs:
+                    if (departures[rows] >= run[1]).all() and (arrivals[rows] >= run[2]).all():
+                        run[0].append(pos); run[1] = departures[rows]; run[2] = arrivals[rows]; break
+                else:
+                    fifo_runs.append([[pos], departures[rows], arrivals[rows]])
+            patterns += [(route_id, run[0]) for run in fifo_runs]
+
+        pattern_stops = []; pattern_trips = []; column_departures = []; column_arrivals = []; column_sizes = []
+        for route_id, trips in patterns:
+            rows = trip_index.offsets[np.asarray(trips)][:, None] + np.arange(trip_index.offsets[trips[0] + 1] - trip_index.offsets[trips[0]])
+            pattern_stops.append(row_stops[rows[0]]); pattern_trips.append(trips)
+            column_departures.append(departures[rows].T.ravel()); column_arrivals.append(arrivals[rows].T.ravel())   # position-major
+            column_sizes.append(np.full(rows.shape[1], len(trips)))
+        pattern_offsets = np.zeros(len(patterns) + 1, dtype=np.int64); np.cumsum([len(stops) for stops in pattern_stops], out=pattern_offsets[1:])
+        pattern_trip_offsets = np.zeros(len(patterns) + 1, dtype=np.int64); np.cumsum([len(trips) for trips in pattern_trips], out=pattern_trip_offsets[1:])
+        column_sizes = np.concatenate(column_sizes) if patterns else np.zeros(0, dtype=np.int64)
+        column_offsets = np.zeros(len(column_sizes) + 1, dtype=np.int64); np.cumsum(column_sizes, out=column_offsets[1:])
+        pattern_stops = np.concatenate(pattern_stops).astype(np.int64) if patterns else np.zeros(0, dtype=np.int64)
+
+        # Stop -> columns that serve it
+        stop_column_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64); np.cumsum(np.bincount(pattern_stops, minlength=len(stop_ids)), out=stop_column_offsets[1:])
+        stop_columns = np.argsort(pattern_stops, kind='stable')
+
+        # Walking transfers between nearby stops, both directions, sorted by origin stop
+        stop_lats = trip_index.stop_lat_table; stop_lons = trip_index.stop_lon_table
+        spatial = StopSpatialIndex(stop_lats, stop_lons)
+        pairs = spatial._tree.query_pairs(transfer_radius_km * spatial.PROJECTION_SLACK, output_type='ndarray') if len(stop_ids) else np.zeros((0, 2), dtype=np.int64)
+        distances = haversine_km_vectorized(stop_lats[pairs[:, 0]], stop_lons[pairs[:, 0]], stop_lats[pairs[:, 1]], stop_lons[pairs[:, 1]])
+        pairs = pairs[distances <= transfer_radius_km]; distances = distances[distances <= transfer_radius_km]
+        from_stops = np.concatenate((pairs[:, 0], pairs[:, 1])); to_stops = np.concatenate((pairs[:, 1], pairs[:, 0])); distances = np.concatenate((distances, distances))
+        order = np.lexsort((distances, from_stops))
+        transfer_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64); np.cumsum(np.bincount(from_stops, minlength=len(stop_ids)), out=transfer_offsets[1:])
+        return cls(stop_ids=stop_ids, stop_lats=stop_lats, stop_lons=stop_lons, pattern_route_ids=np.asarray([route_id for route_id, _ in patterns], dtype=trip_index.trip_route_ids.dtype),
+                   pattern_offsets=pattern_offsets, pattern_stops=pattern_stops, pattern_trip_offsets=pattern_trip_offsets,
+                   pattern_trips=np.concatenate(pattern_trips).astype(np.int64) if patterns else np.zeros(0, dtype=np.int64),
+                   column_offsets=column_offsets, column_departures=np.concatenate(column_departures).astype(np.int32) if patterns else np.zeros(0, dtype=np.int32),
+                   column_arrivals=np.concatenate(column_arrivals).astype(np.int32) if patterns else np.zeros(0, dtype=np.int32),
+                   stop_column_offsets=stop_column_offsets, stop_columns=stop_columns, transfer_offsets=transfer_offsets, transfer_stops=to_stops[order].astype(np.int64),
+                   transfer_seconds=np.ceil(distances[order] * cls.WALK_SECONDS_PER_KM).astype(np.int32))
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def stop_positions(self, stop_ids):
+        """Dense stop numbers for GTFS stop_ids (-1 for stops no trip serves)."""
+        stop_ids = np.asarray(stop_ids, dtype=self.stop_ids.dtype)
+        if len(self.stop_ids) == 0: return np.full(len(stop_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.stop_ids, stop_ids), len(self.stop_ids) - 1)
+        return np.where(self.stop_ids[positions] == stop_ids, positions, -1)
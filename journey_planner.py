@@ -0,0 +1,217 @@
+# journey_planner.py
+# Multi-leg journey planning over gtfs_index.TransitNetwork with RAPTOR
+# (Delling, Pajor & Werneck, "Round-Based Public Transit Routing"). Round k
+# finds the earliest arrival at every stop using at most k buses: it scans
+# only the patterns serving stops that improved in round k - 1, then relaxes
+# walking transfers from the stops it improved. Each round is a handful of
+# vectorized NumPy passes, and keeping the best destination arrival per round
+# gives the Pareto set of (arrival time, number of transfers).
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from gtfs_index import MISSING_TIME, SECONDS_PER_DAY, expand_row_ranges
+
+MAX_TRANSFERS = 3
+MIN_TRANSFER_SECONDS = 60      # to get off one bus and be ready at the next stop
+MAX_EARLY_SECONDS = 300; MAX_LATE_SECONDS = 3600   # live lateness is clipped to this range
+UNREACHED = np.iinfo(np.int64).max // 4
+
+JourneyPlan = namedtuple('JourneyPlan', ['journeys', 'rounds', 'truncated'])
+LiveSchedule = namedtuple('LiveSchedule', ['trip_delays', 'smallest_delays', 'largest_delays', 'ranks', 'slots'])
+
+
+# --- Live delays ---
+def live_trip_delays(trip_index, trip_ids, lats, lons, now_seconds, located=None):
+    """Per-trip lateness in whole seconds, indexed by trip position (0 for trips with no bus on the road).
+
+    Each bus is snapped onto its trip (or placed by `located`, a (last_rows,
+    progress) pair from an earlier snap) and compared with the schedule
+    interpolated between the two stops around it; the delay is applied to the
+    rest of that trip.
+    """
+    delays = np.zeros(len(trip_index), dtype=np.int64)
+    positions = trip_index.trip_positions(list(trip_ids))
+    last_rows, progress = trip_index.locate_vehicles(trip_ids, lats, lons)[:2] if located is None else located
+    located = np.flatnonzero(last_rows >= 0)
+    rows = last_rows[located]
+    leave = trip_index.departure_seconds[rows].astype(np.float64); reach = trip_index.arrival_seconds[rows + 1].astype(np.float64)
+    timed = (leave != MISSING_TIME) & (reach != MISSING_TIME)
+    scheduled = leave + progress[located] * (reach - leave)
+    # Trips past midnight keep GTFS times over 24:00, so take the lateness modulo a day
+    lateness = (now_seconds - scheduled + SECONDS_PER_DAY / 2) % SECONDS_PER_DAY - SECONDS_PER_DAY / 2
+    delays[positions[located][timed]] = np.clip(np.rint(lateness[timed]), -MAX_EARLY_SECONDS, MAX_LATE_SECONDS)
+    return delays
+
+
+# --- Rounds ---
+def _first_at_or_after(values, starts, ends, targets):
+    """Binary search in many sorted slices at once: first index in [start, end) with values >= target (end if none)."""
+    lo = starts.copy(); hi = ends.copy(); last = max(len(values) - 1, 0)
+    while True:
+        active = lo < hi
+        if not active.any(): return lo
+        mid = (lo + hi) // 2
+        go_right = active & (values[np.minimum(mid, last)] < targets)
+        lo = np.where(go_right, mid + 1, lo); hi = np.where(active & ~go_right, mid, hi)
+
+def _live_schedule(network, trip_delays):
+    """Per-pattern view of live delays: the smallest and largest delay among the pattern's trips, and its trips ranked
+    by when they actually leave the first stop (ranks maps slot to rank, slots rank to slot, both within the pattern)."""
+    starts = network.pattern_trip_offsets[:-1]; counts = np.diff(network.pattern_trip_offsets)
+    patterns = np.repeat(np.arange(len(counts)), counts); slots = np.arange(len(patterns)) - np.repeat(starts, counts)
+    delays = trip_delays[network.pattern_trips]
+    leaves = network.column_departures[network.column_offsets[network.pattern_offsets[patterns]] + slots] + delays
+    order = np.lexsort((slots, leaves, patterns)); ranks = np.empty_like(slots); ranks[order] = slots
+    smallest, largest = (np.minimum.reduceat(delays, starts), np.maximum.reduceat(delays, starts)) if len(delays) else (delays, delays)
+    return LiveSchedule(trip_delays, smallest, largest, ranks, slots[order])
+
+def _earliest_trips(network, columns, ready, live):
+    """For each column, the slot of the trip that leaves first at or after ready (-1 if none)."""
+    starts = network.column_offsets[columns]; ends = network.column_offsets[columns + 1]
+    if live is None:
+        slots = _first_at_or_after(network.column_departures, starts, ends, ready)
+        return np.where(slots < ends, slots - starts, -1)
+
+    # Delays can reorder a column. Trips scheduled before ready minus the pattern's largest delay are gone however late
+    # they run; from there, scan while a trip could still leave before the best catchable one found, given the smallest delay.
+    patterns = network.column_patterns[columns]; smallest, largest = live.smallest_delays[patterns], live.largest_delays[patterns]
+    trip_offsets = network.pattern_trip_offsets[patterns] - starts
+    slots = _first_at_or_after(network.column_departures, starts, ends, ready - largest)
+    chosen = np.full(len(columns), -1, dtype=np.int64); leaves_at = np.full(len(columns), UNREACHED, dtype=np.int64)
+    scanning = np.flatnonzero(slots < ends)
+    while len(scanning):
+        slot = slots[scanning]
+        leaves = network.column_departures[slot] + live.trip_delays[network.pattern_trips[trip_offsets[scanning] + slot]]
+        better = (leaves >= ready[scanning]) & (leaves < leaves_at[scanning])
+        chosen[scanning[better]] = slot[better]; leaves_at[scanning[better]] = leaves[better]
+        slot += 1; slots[scanning] = slot
+        more = slot < ends[scanning]
+        more[more] = network.column_departures[slot[more]] + smallest[scanning[more]] < leaves_at[scanning[more]]
+        scanning = scanning[more]
+    return np.where(chosen >= 0, chosen - starts, -1)
+
+def _ride(network, marked, labels, board_slack, live):
+    """Scans every pattern through a marked stop; returns (stop, arrival, board column, alight column, trip slot) per reachable column."""
+    entries, _, _ = expand_row_ranges(network.stop_column_offsets[marked], network.stop_column_offsets[marked + 1])
+    columns = network.stop_columns[entries]
+    patterns = network.column_patterns[columns]; positions = network.column_positions[columns]
+    boardable = columns + 1 < network.pattern_offsets[patterns + 1]   # nothing to ride from a pattern's last stop
+    columns, patterns, positions = columns[boardable], patterns[boardable], positions[boardable]
+    slots = _earliest_trips(network, columns, labels[network.pattern_stops[columns]] + board_slack, live)
+    caught = slots >= 0
+    columns, patterns, positions, slots = columns[caught], patterns[caught], positions[caught], slots[caught]
+    empty = np.zeros(0, dtype=np.int64)
+    if len(columns) == 0: return empty, empty, empty, empty, empty
+
+    # Lay the touched patterns out one after another and mark each boarding as key = order * span + position, where
+    # order is the slot (or, with live delays, the trip's rank by when it actually runs); the running minimum of the key
+    # along a pattern is the earliest trip we can be on at each stop
+    touched, segment = np.unique(patterns, return_inverse=True)
+    scan, lengths, group_starts = expand_row_ranges(network.pattern_offsets[touched], network.pattern_offsets[touched + 1])
+    span = network.max_pattern_length; none = network.max_pattern_trips * span
+    keys = np.full(len(scan), none, dtype=np.int64)
+    orders = slots if live is None else live.ranks[network.pattern_trip_offsets[patterns] + slots]
+    np.minimum.at(keys, group_starts[segment] + positions, orders * span + positions)
+    # Segmented running minimum in one pass: lift earlier patterns above anything later patterns can hold
+    lift = np.repeat((len(touched) - np.arange(len(touched))) * (none + 1), lengths)
+    running = np.minimum.accumulate(keys + lift) - lift
+    on_board = np.empty_like(running); on_board[1:] = running[:-1]; on_board[group_starts] = none   # boarded strictly upstream
+    riding = np.flatnonzero(on_board < none)
+    scan, on_board = scan[riding], on_board[riding]
+    slots = on_board // span; patterns = network.column_patterns[scan]
+    if live is not None: slots = live.slots[network.pattern_trip_offsets[patterns] + slots]
+    arrivals = network.column_arrivals[network.column_offsets[scan] + slots].astype(np.int64)
+    if live is not None: arrivals += live.trip_delays[network.pattern_trips[network.pattern_trip_offsets[patterns] + slots]]
+    return network.pattern_stops[scan], arrivals, network.pattern_offsets[patterns] + on_board % span, scan, slots
+
+def _earliest_per_stop(stops, arrivals, *extra):
+    """Keeps the earliest arrival per stop, with the matching entries of the extra arrays."""
+    order = np.lexsort((arrivals, stops)); stops = stops[order]
+    first = np.flatnonzero(np.concatenate(([True], stops[1:] != stops[:-1]))) if len(stops) else order[:0]
+    return (stops[first], arrivals[order][first]) + tuple(values[order][first] for values in extra)
+
+
+# --- Query ---
+def plan_journeys(network, origin_stops, origin_seconds, target_stops, target_seconds, depart_seconds, max_transfers=MAX_TRANSFERS, time_budget_seconds=None, trip_delays=None):
+    """Pareto-optimal journeys (arrival time vs. transfers) from the origin stops to the target stops.
+
+    Stops are dense TransitNetwork numbers; origin_seconds/target_seconds are
+    the walks between the traveller's points and those stops. trip_delays
+    (from live_trip_delays) shifts the schedule of trips that are running late
+    or early. Rounds stop early once time_budget_seconds is spent, and the
+    plan says so in its truncated flag.
+    """
+    deadline = None if time_budget_seconds is None else time.perf_counter() + time_budget_seconds
+    n = len(network); origin_stops = np.asarray(origin_stops, dtype=np.int64); target_stops = np.asarray(target_stops, dtype=np.int64)
+    access = np.full(n, UNREACHED, dtype=np.int64); np.minimum.at(access, origin_stops, np.asarray(origin_seconds, dtype=np.int64))
+    egress = np.full(n, UNREACHED, dtype=np.int64); np.minimum.at(egress, target_stops, np.asarray(target_seconds, dtype=np.int64))
+    target_stops = np.unique(target_stops)
+    labels = [np.where(access < UNREACHED, depart_seconds + access, UNREACHED)]
+    best = labels[0].copy(); best_target = UNREACHED
+    rides = [None]; walks = [None]   # per round: stop -> (board column, alight column, trip slot, arrival) / (from stop, seconds)
+    marked = np.unique(origin_stops); journeys = []; truncated = False
+    live = None if trip_delays is None else _live_schedule(network, trip_delays)
+    by_bus = np.zeros(n, dtype=bool)   # round-0 labels are the access walk alone, not a journey
+
+    for k in range(1, max_transfers + 2):
+        if len(marked) == 0: break
+        if deadline is not None and k > 1 and time.perf_counter() > deadline: truncated = True; break
+        current = labels[-1].copy()
+        ride = (np.full(n, -1, dtype=np.int64), np.full(n, -1, dtype=np.int64), np.full(n, -1, dtype=np.int64), np.full(n, UNREACHED, dtype=np.int64))
+        walk = (np.full(n, -1, dtype=np.int64), np.zeros(n, dtype=np.int64))
+
+        stops, arrivals, boards, alights, slots = _ride(network, marked, labels[-1], MIN_TRANSFER_SECONDS if k > 1 else 0, live)
+        improves = arrivals < np.minimum(best[stops], best_target)
+        stops, arrivals, boards, alights, slots = _earliest_per_stop(stops[improves], arrivals[improves], boards[improves], alights[improves], slots[improves])
+        current[stops] = arrivals; best[stops] = arrivals
+        ride[0][stops] = boards; ride[1][stops] = alights; ride[2][stops] = slots; ride[3][stops] = arrivals
+
+        entries, counts, _ = expand_row_ranges(network.transfer_offsets[stops], network.transfer_offsets[stops + 1])
+        from_stops = np.repeat(stops, counts); to_stops = network.transfer_stops[entries]
+        walk_arrivals = arrivals.repeat(counts) + network.transfer_seconds[entries]
+        improves = walk_arrivals < np.minimum(best[to_stops], best_target)
+        to_stops, walk_arrivals, from_stops, walk_seconds = _earliest_per_stop(to_stops[improves], walk_arrivals[improves], from_stops[improves], network.transfer_seconds[entries][improves])
+        current[to_stops] = walk_arrivals; best[to_stops] = walk_arrivals
+        walk[0][to_stops] = from_stops; walk[1][to_stops] = walk_seconds
+
+        labels.append(current); rides.append(ride); walks.append(walk)
+        marked = np.union1d(stops, to_stops); by_bus[marked] = True
+        at_target = np.where(by_bus[target_stops], current[target_stops] + egress[target_stops], UNREACHED)
+        arrival = int(at_target.min()) if len(target_stops) else UNREACHED
+        if arrival < best_target:
+            best_target = arrival; stop = int(target_stops[np.argmin(at_target)])
+            journeys.append(_journey(network, rides, walks, access, k, stop, int(egress[stop]), arrival, trip_delays))
+    return JourneyPlan(journeys, len(labels) - 1, truncated)
+
+def _stop_id(network, stop):
+    return network.stop_ids[stop:stop + 1].tolist()[0]   # a plain Python id, whatever the array's dtype
+
+def _journey(network, rides, walks, access, k, stop, egress_seconds, arrival_seconds, trip_delays):
+    """Follows the parent pointers back from the target stop found in round k."""
+    legs = [{'mode': 'walk', 'from_stop_id': _stop_id(network, stop), 'to_stop_id': None, 'seconds': egress_seconds}]
+    after_walk = False
+    while k > 0:
+        boards, alights, slots, _ = rides[k]
+        if not after_walk and walks[k][0][stop] >= 0:
+            from_stop = int(walks[k][0][stop])
+            legs.append({'mode': 'walk', 'from_stop_id': _stop_id(network, from_stop), 'to_stop_id': _stop_id(network, stop), 'seconds': int(walks[k][1][stop])})
+            stop = from_stop; after_walk = True; continue
+        after_walk = False
+        if boards[stop] < 0: k -= 1; continue   # label carried over from the previous round
+        board, alight, slot = int(boards[stop]), int(alights[stop]), int(slots[stop])
+        pattern = int(network.column_patterns[alight]); trip = int(network.pattern_trips[network.pattern_trip_offsets[pattern] + slot])
+        delay = 0 if trip_delays is None else int(trip_delays[trip])
+        legs.append({'mode': 'bus', 'route_id': network.pattern_route_ids[pattern:pattern + 1].tolist()[0], 'trip_position': trip,
+                     'from_stop_id': _stop_id(network, network.pattern_stops[board]), 'to_stop_id': _stop_id(network, stop),
+                     'departure_seconds': int(network.column_departures[network.column_offsets[board] + slot]) + delay,
+                     'arrival_seconds': int(network.column_arrivals[network.column_offsets[alight] + slot]) + delay,
+                     'delay_seconds': delay, 'stops': alight - board})
+        stop = int(network.pattern_stops[board]); k -= 1
+    legs.append({'mode': 'walk', 'from_stop_id': None, 'to_stop_id': _stop_id(network, stop), 'seconds': int(access[stop])})
+    legs.reverse()
+    bus_legs = [leg for leg in legs if leg['mode'] == 'bus']
+    return {'departure_seconds': bus_legs[0]['departure_seconds'] - legs[0]['seconds'], 'arrival_seconds': arrival_seconds,
+            'transfers': len(bus_legs) - 1, 'legs': legs}
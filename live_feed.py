@@ -0,0 +1,132 @@
+# live_feed.py
+# Shared poller for the GTFS-realtime VehiclePositions feed. One background
+# thread per process fetches the feed on its own cadence and publishes an
+# immutable, versioned snapshot that every endpoint reads, so user requests
+# never wait on the upstream.
+
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+from feed_decoder import VehiclePositionsDecoder
+from metrics import registry, span
+
+
+# --- Snapshot ---
+class FeedSnapshot(namedtuple('FeedSnapshot', ['version', 'vehicles', 'feed_timestamp', 'fetched_at', 'checked_at'])):
+    """One published view of the live feed. Treat `vehicles` as read-only: it is shared by every request."""
+    __slots__ = ()
+
+    def age_seconds(self, now=None):
+        """Seconds since the feed produced this data (falls back to when we downloaded it)."""
+        if self.fetched_at is None: return None
+        now = time.time() if now is None else now
+        reference = self.feed_timestamp if self.feed_timestamp else self.fetched_at
+        return max(0.0, now - reference)
+
+    def status(self, stale_after, now=None):
+        """Small JSON-safe summary that endpoints attach to their responses."""
+        now = time.time() if now is None else now
+        age = self.age_seconds(now)
+        return {'snapshot_version': self.version, 'feed_timestamp': self.feed_timestamp,
+                'snapshot_age_seconds': None if age is None else round(age, 1),
+                'stale': self.checked_at is None or (now - self.checked_at) > stale_after}
+
+EMPTY_SNAPSHOT = FeedSnapshot(version=0, vehicles=None, feed_timestamp=None, fetched_at=None, checked_at=None)
+
+
+# --- Decoding ---
+def decode_vehicle_positions(content, decoder=None):
+    """Parses raw VehiclePositions bytes into (feed_timestamp, vehicles DataFrame or None)."""
+    columns = (decoder or VehiclePositionsDecoder()).decode(content)
+    return columns.feed_timestamp, columns.to_frame()
+
+
+# --- Poller ---
+class LiveFeedPoller:
+    """Polls the upstream feed in a daemon thread and keeps the last good snapshot.
+
+    The poll interval follows the feed's own header timestamps (clamped to
+    [min_interval, max_interval]) and backs off on failures. Requests are
+    conditional (ETag / Last-Modified), so an unchanged feed costs a 304.
+    """
+
+    def __init__(self, url, min_interval=10, max_interval=60, timeout=15, stale_after=120):
+        self.url = url; self.min_interval = min_interval; self.max_interval = max_interval
+        self.timeout = timeout; self.stale_after = stale_after
+        self.interval = min_interval
+        self.last_error = None; self.consecutive_failures = 0
+        self._session = requests.Session()
+        self._etag = None; self._last_modified = None
+        self._snapshot = EMPTY_SNAPSHOT
+        self._publish_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._subscribers = []
+        self._decoder = VehiclePositionsDecoder()   # only used on the poller thread
+
+    def current(self):
+        """Returns the latest published snapshot. Never blocks on the network."""
+        return self._snapshot
+
+    def subscribe(self, callback):
+        """Calls callback(snapshot) on the poller thread each time a new snapshot is published."""
+        self._subscribers.append(callback)
+
+    def status(self, snapshot=None, now=None):
+        status = (self._snapshot if snapshot is None else snapshot).status(self.stale_after, now)
+        status['last_error'] = self.last_error
+        return status
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive(): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='live-feed-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def poll_once(self):
+        """Fetches the feed once. Returns True if a new snapshot was published."""
+        headers = {}
+        if self._etag: headers['If-None-Match'] = self._etag
+        if self._last_modified: headers['If-Modified-Since'] = self._last_modified
+        try:
+            with span('feed_fetch'): response = self._session.get(self.url, headers=headers, timeout=self.timeout)
+            now = time.time()
+            if response.status_code == 304:
+                self._mark_checked(now); return False
+            response.raise_for_status()
+            with span('feed_decode'): columns = self._decoder.decode(response.content); feed_timestamp = columns.feed_timestamp
+            self._etag = response.headers.get('ETag'); self._last_modified = response.headers.get('Last-Modified')
+            previous = self._snapshot
+            if feed_timestamp is not None and feed_timestamp == previous.feed_timestamp:
+                self._mark_checked(now); return False
+            if feed_timestamp and previous.feed_timestamp and feed_timestamp > previous.feed_timestamp:
+                self.interval = min(self.max_interval, max(self.min_interval, feed_timestamp - previous.feed_timestamp))
+            with span('feed_to_frame'): vehicles = columns.to_frame()
+            with self._publish_lock:
+                self._snapshot = snapshot = FeedSnapshot(version=previous.version + 1, vehicles=vehicles, feed_timestamp=feed_timestamp, fetched_at=now, checked_at=now)
+            self.last_error = None; self.consecutive_failures = 0
+            with span('feed_subscribers'):
+                for callback in self._subscribers: callback(snapshot)
+            return True
+        except Exception as e:
+            self.last_error = str(e); self.consecutive_failures += 1; registry.count_failure('LiveFeedPoller.poll_once')
+            print(f"An error occurred while fetching live data (serving last good snapshot): {e}", file=sys.stderr)
+            return False
+
+    def _mark_checked(self, now):
+        with self._publish_lock:
+            self._snapshot = self._snapshot._replace(checked_at=now)
+        self.last_error = None; self.consecutive_failures = 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll_once()
+            wait = self.interval if self.consecutive_failures == 0 else min(self.max_interval, self.min_interval * 2 ** self.consecutive_failures)
+            self._stop.wait(wait)
@@ -0,0 +1,122 @@
+# live_stats.py
+# Incremental system-stats engine. It runs once per new feed snapshot (as a
+# LiveFeedPoller subscriber), re-scores delays only for buses that appeared,
+# moved or changed trip, and keeps rolling citywide and per-route aggregates
+# so /get-system-stats just returns the latest precomputed result.
+
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from metrics import registry, span
+
+ON_TIME_THRESHOLD_SECONDS = 300
+POSITION_EPSILON_DEGREES = 1e-5   # ~1 m; smaller moves keep the previous delay
+
+
+def summarize_delays(delays):
+    """Mean, median, p90 (minutes) and on-time share of an array of delay seconds (NaNs ignored)."""
+    delays = np.asarray(delays, dtype=np.float64); delays = delays[~np.isnan(delays)]
+    if len(delays) == 0:
+        return {'sample_count': 0, 'avg_delay_minutes': None, 'p50_delay_minutes': None, 'p90_delay_minutes': None, 'on_time_percentage': None}
+    p50, p90 = np.percentile(delays, [50, 90])
+    return {'sample_count': int(len(delays)), 'avg_delay_minutes': float(np.mean(delays)) / 60, 'p50_delay_minutes': float(p50) / 60,
+            'p90_delay_minutes': float(p90) / 60, 'on_time_percentage': float(np.mean(np.abs(delays) <= ON_TIME_THRESHOLD_SECONDS)) * 100}
+
+def summarize_delays_by_route(route_ids, delays):
+    """summarize_delays per route, as {route_id: summary}."""
+    frame = pd.DataFrame({'route_id': route_ids, 'delay': delays}).dropna(subset=['delay'])
+    if frame.empty: return {}
+    frame['on_time'] = frame['delay'].abs() <= ON_TIME_THRESHOLD_SECONDS
+    grouped = frame.groupby('route_id')
+    table = pd.DataFrame({'sample_count': grouped['delay'].size(), 'avg_delay_minutes': grouped['delay'].mean() / 60,
+                          'p50_delay_minutes': grouped['delay'].quantile(0.5) / 60, 'p90_delay_minutes': grouped['delay'].quantile(0.9) / 60,
+                          'on_time_percentage': grouped['on_time'].mean() * 100})
+    return {int(route_id): {'sample_count': int(row.sample_count), 'avg_delay_minutes': float(row.avg_delay_minutes), 'p50_delay_minutes': float(row.p50_delay_minutes),
+                            'p90_delay_minutes': float(row.p90_delay_minutes), 'on_time_percentage': float(row.on_time_percentage)}
+            for route_id, row in zip(table.index, table.itertuples(index=False))}
+
+
+class SystemStatsEngine:
+    """Keeps per-vehicle delays and rolling aggregates up to date as feed snapshots arrive.
+
+    attach_routes(vehicles_df) must return the vehicles with a known trip plus
+    a route_id column; compute_delays(buses_df) must return delay seconds per
+    row (NaN where unknown). Windows are in seconds, e.g. (300, 900).
+    """
+
+    def __init__(self, attach_routes, compute_delays, windows=(300, 900)):
+        self.attach_routes = attach_routes; self.compute_delays = compute_delays
+        self.windows = tuple(sorted(windows))
+        self.last_diff = {'appeared': 0, 'moved': 0, 'unchanged': 0, 'disappeared': 0}
+        self._vehicles = None; self._hour = None
+        self._samples = deque()   # (processed_at, route_ids, delays) for each processed snapshot
+        self._published = None    # (snapshot, citywide payload, per-route payload)
+        self._lock = threading.Lock()
+
+    def current(self):
+        """(snapshot, citywide payload, per-route payload) from the last processed snapshot, or None before the first."""
+        return self._published
+
+    def on_snapshot(self, snapshot):
+        """Feed-poller subscriber: never raises, so a bad snapshot can't stop the poller."""
+        try:
+            with self._lock, span('stats_update'): self._process(snapshot)
+        except Exception:
+            registry.count_failure('SystemStatsEngine.on_snapshot')
+            print("Stats engine failed to process snapshot; keeping the previous aggregates.", file=sys.stderr); traceback.print_exc()
+
+    def _update_vehicle_delays(self, vehicles):
+        now = datetime.now()
+        current = self.attach_routes(vehicles).drop_duplicates('vehicle_id', keep='last').set_index('vehicle_id')
+        previous = self._vehicles if self._vehicles is not None and self._hour == (now.date(), now.hour) else None
+        if previous is None:
+            unchanged = pd.Series(False, index=current.index); delays = pd.Series(np.nan, index=current.index)
+        else:
+            before = previous.reindex(current.index)
+            unchanged = (before['trip_id'] == current['trip_id']) & ((before['latitude'] - current['latitude']).abs() <= POSITION_EPSILON_DEGREES) & ((before['longitude'] - current['longitude']).abs() <= POSITION_EPSILON_DEGREES)
+            delays = before['delay'].where(unchanged)
+        changed = current[~unchanged]
+        if len(changed): delays[~unchanged] = self.compute_delays(changed.reset_index(), now=now)
+        current['delay'] = delays.to_numpy()
+
+        seen_before = current.index.isin(previous.index) if previous is not None else np.zeros(len(current), dtype=bool)
+        self.last_diff = {'appeared': int((~seen_before).sum()), 'moved': int((seen_before & ~unchanged.to_numpy()).sum()), 'unchanged': int(unchanged.sum()),
+                          'disappeared': 0 if previous is None else int((~previous.index.isin(current.index)).sum())}
+        self._vehicles = current; self._hour = (now.date(), now.hour)
+        return current
+
+    def _process(self, snapshot):
+        vehicles = snapshot.vehicles; processed_at = time.time()
+        if vehicles is None or vehicles.empty:
+            self._vehicles = None
+            self._published = (snapshot, {'active_buses_count': 0, 'avg_delay_minutes': 'N/A', 'on_time_percentage': 'N/A', 'routes_covered_count': 0, 'last_updated': datetime.now().isoformat()}, {})
+            return
+        current = self._update_vehicle_delays(vehicles)
+        route_ids = current['route_id'].to_numpy(); delays = current['delay'].to_numpy(dtype=np.float64)
+
+        self._samples.append((processed_at, route_ids, delays))
+        while self._samples and self._samples[0][0] < processed_at - self.windows[-1]: self._samples.popleft()
+        window_stats = {}; route_window_stats = {}
+        for window in self.windows:
+            in_window = [sample for sample in self._samples if sample[0] >= processed_at - window]
+            window_routes = np.concatenate([sample[1] for sample in in_window]); window_delays = np.concatenate([sample[2] for sample in in_window])
+            label = f"{window // 60}m"
+            window_stats[label] = summarize_delays(window_delays); route_window_stats[label] = summarize_delays_by_route(window_routes, window_delays)
+
+        now_summary = summarize_delays(delays)
+        payload = {'active_buses_count': len(vehicles), 'avg_delay_minutes': now_summary['avg_delay_minutes'] if now_summary['sample_count'] else 0,
+                   'on_time_percentage': now_summary['on_time_percentage'] if now_summary['sample_count'] else 100,
+                   'routes_covered_count': int(pd.unique(route_ids).size), 'last_updated': datetime.now().isoformat(),
+                   'p50_delay_minutes': now_summary['p50_delay_minutes'], 'p90_delay_minutes': now_summary['p90_delay_minutes'],
+                   'windows': window_stats, 'vehicle_changes': dict(self.last_diff)}
+        routes_payload = {}
+        for label, per_route in route_window_stats.items():
+            for route_id, summary in per_route.items(): routes_payload.setdefault(route_id, {})[label] = summary
+        self._published = (snapshot, payload, routes_payload)
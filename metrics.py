@@ -0,0 +1,181 @@
+# metrics.py
+# Lightweight instrumentation for the prediction API: latency spans per
+# stage, counters for failures that are swallowed (logged and turned into a
+# None/[] result instead of an error response), a Prometheus text exposition
+# of both, an opt-in per-request Server-Timing breakdown and an on-demand
+# sampling profiler that writes folded stacks for flamegraph.pl/speedscope.
+
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+DURATION_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TIMING_REQUEST_HEADER = 'X-Request-Timing'   # send "X-Request-Timing: 1" to get a Server-Timing header back
+METRIC_PREFIX = 'smartbus'
+HISTOGRAMS = {'stage': ('stage_duration_seconds', 'stage', 'Time spent in each request or background stage.'),
+              'request': ('request_duration_seconds', 'endpoint', 'End-to-end time per API endpoint.')}
+
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+
+# --- Registry ---
+class MetricsRegistry:
+    """Thread-safe duration histograms and swallowed-failure counters, rendered in Prometheus text format."""
+
+    def __init__(self, buckets=DURATION_BUCKETS_SECONDS):
+        self.buckets = tuple(buckets)
+        self._histograms = {kind: defaultdict(lambda: [[0] * len(self.buckets), 0.0, 0]) for kind in HISTOGRAMS}   # label -> [bucket counts, sum, count]
+        self._failures = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, kind, label, seconds):
+        with self._lock:
+            series = self._histograms[kind][label]
+            for i, upper in enumerate(self.buckets):
+                if seconds <= upper: series[0][i] += 1
+            series[1] += seconds; series[2] += 1
+
+    def count_failure(self, function):
+        with self._lock: self._failures[function] += 1
+
+    def failures(self):
+        with self._lock: return dict(self._failures)
+
+    def render(self, gauges=None):
+        """Prometheus text exposition; gauges is {name: (help, value or {label_name: {label_value: value}})}."""
+        lines = []
+        with self._lock:
+            for kind, (name, label_name, help_text) in HISTOGRAMS.items():
+                name = f"{METRIC_PREFIX}_{name}"
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for label, (bucket_counts, total, count) in sorted(self._histograms[kind].items()):
+                    label = _escape(label)
+                    lines += [f'{name}_bucket{{{label_name}="{label}",le="{upper:g}"}} {bucket_count}' for upper, bucket_count in zip(self.buckets, bucket_counts)]
+                    lines += [f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}', f'{name}_sum{{{label_name}="{label}"}} {total:.6f}', f'{name}_count{{{label_name}="{label}"}} {count}']
+            name = f"{METRIC_PREFIX}_swallowed_failures_total"
+            lines += [f"# HELP {name} Exceptions caught and turned into an empty result, per function.", f"# TYPE {name} counter"]
+            lines += [f'{name}{{function="{_escape(function)}"}} {count}' for function, count in sorted(self._failures.items())]
+        for gauge, (help_text, value) in (gauges or {}).items():
+            name = f"{METRIC_PREFIX}_{gauge}"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            if isinstance(value, dict):
+                for label_name, series in value.items():
+                    lines += [f'{name}{{{label_name}="{_escape(label)}"}} {_number(v)}' for label, v in series.items() if v is not None]
+            elif value is not None:
+                lines.append(f"{name} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    return repr(float(value)) if not isinstance(value, bool) else str(int(value))
+
+registry = MetricsRegistry()
+
+
+# --- Spans ---
+@contextmanager
+def span(stage):
+    """Times a block into the stage histogram and, when the current request opted in, its timing breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        registry.observe('stage', stage, elapsed)
+        stages = _request_stages.get()
+        if stages is not None: stages.append((stage, elapsed))
+
+def timed(stage):
+    """Decorator form of span()."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage): return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def record_failure(function, error):
+    """Counts (and logs) an exception that the caller is about to swallow."""
+    registry.count_failure(function)
+    print(f"{function} failed, returning an empty result: {type(error).__name__}: {error}", file=sys.stderr)
+
+def start_request_timing():
+    """Starts collecting spans for the current request; pass the token to finish_request_timing."""
+    return _request_stages.set([])
+
+def finish_request_timing(token):
+    """Stops collecting and returns the Server-Timing header value (repeated stages are summed, in first-seen order)."""
+    stages = _request_stages.get() or []; _request_stages.reset(token)
+    totals = {}
+    for stage, elapsed in stages: totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ', '.join(f"{stage};dur={elapsed * 1000:.2f}" for stage, elapsed in totals.items())
+
+def collect_stages(function, *args):
+    """Runs function with spans collected apart from the current request; returns (result, [(stage, seconds), ...])."""
+    token = _request_stages.set([])
+    try:
+        return function(*args), _request_stages.get()
+    finally:
+        _request_stages.reset(token)
+
+def add_request_stages(stages):
+    """Adds spans timed elsewhere (e.g. by collect_stages) to the current request's breakdown, if it opted in."""
+    current = _request_stages.get()
+    if current is not None: current.extend(stages)
+
+
+# --- Sampling Profiler ---
+class SamplingProfiler:
+    """Samples every thread's Python stack at a fixed interval while running.
+
+    stop() returns the samples in folded-stack format ("thread;frame;frame
+    count" per line), ready for flamegraph.pl or speedscope, and can also
+    write them to a file.
+    """
+
+    def __init__(self):
+        self._samples = Counter(); self._thread = None; self._stop = threading.Event()
+        self.started_at = None; self.interval = None; self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=0.005):
+        with self._lock:
+            if self.running: return False
+            self._samples = Counter(); self._stop.clear(); self.interval = interval; self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True); self._thread.start()
+            return True
+
+    def stop(self, out_dir=None):
+        """Stops sampling; returns (folded text, path written or None)."""
+        with self._lock:
+            if self._thread is None: return '', None
+            self._stop.set(); self._thread.join(); self._thread = None
+            folded = ''.join(f"{stack} {count}\n" for stack, count in self._samples.most_common())
+        path = None
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True); path = os.path.join(out_dir, f"profile-{int(self.started_at)}.folded")
+            with open(path, 'w') as f: f.write(folded)
+        return folded, path
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code; stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"); frame = frame.f_back
+                self._samples[';'.join([names.get(thread_id, str(thread_id))] + stack[::-1])] += 1
+
+profiler = SamplingProfiler()
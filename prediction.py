@@ -0,0 +1,183 @@
+# prediction.py
+# Feature assembly and batched scoring for the segment travel-time model
+# (bus_eta_model.pkl). Every (bus, segment) pair in a request is scored in one
+# model.predict call instead of one single-row DataFrame per segment. Large
+# batches can be fanned out to a pool of forked worker processes.
+
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from metrics import record_failure, timed
+
+WEEKDAY_COLUMNS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+FEATURE_COLUMNS = ['route_id', 'stop_id', 'stop_sequence', 'hour_of_day'] + WEEKDAY_COLUMNS
+
+
+class SegmentPredictionCache:
+    """Bounded LRU of segment predictions for the current (weekday, hour).
+
+    The model only sees route, stop, sequence, hour and weekday, so within one
+    hour a segment's prediction never changes. Entries are keyed by
+    (route_id, stop_id, stop_sequence) and the whole cache is dropped when the
+    hour rolls over. It only rolls forward: a request still working on an
+    earlier hour bypasses the cache rather than wiping the new hour.
+    """
+
+    def __init__(self, maxsize=250_000):
+        self.maxsize = maxsize
+        self.hits = 0; self.misses = 0; self.evictions = 0; self.invalidations = 0
+        self._entries = OrderedDict(); self._bucket = None
+        self._lock = threading.Lock()
+
+    def _roll_over(self, when):
+        """Moves to when's hour if it is newer; False if when is older than the cached hour."""
+        bucket = (when.date(), when.hour)
+        if self._bucket is not None and bucket < self._bucket: return False
+        if bucket != self._bucket:
+            if self._entries: self.invalidations += 1
+            self._entries.clear(); self._bucket = bucket
+        return True
+
+    def get_many(self, keys, when):
+        """Cached prediction for each key, or None on a miss."""
+        with self._lock:
+            if not self._roll_over(when): self.misses += len(keys); return [None] * len(keys)
+            values = []
+            for key in keys:
+                value = self._entries.get(key)
+                if value is None: self.misses += 1
+                else: self.hits += 1; self._entries.move_to_end(key)
+                values.append(value)
+            return values
+
+    def put_many(self, keys, values, when):
+        with self._lock:
+            if not self._roll_over(when): return
+            for key, value in zip(keys, values):
+                self._entries[key] = value; self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False); self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else None, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'hour_bucket': None if self._bucket is None else f"{self._bucket[0].isoformat()} {self._bucket[1]:02d}:00"}
+
+
+class SegmentModel:
+    """Scores segment travel times for many (route, stop, sequence) rows at once.
+
+    Category dtypes for route_id and stop_id are fixed from the static GTFS
+    data at startup, so building a batch never re-derives categories. With a
+    SegmentPredictionCache attached, only rows not yet scored this hour reach
+    the model.
+    """
+
+    def __init__(self, model, route_ids, stop_ids, cache=None, pool=None):
+        self.model = model; self.cache = cache; self.pool = pool
+        self.route_dtype = pd.CategoricalDtype(np.unique(np.asarray(route_ids, dtype=np.int64)))
+        self.stop_dtype = pd.CategoricalDtype(np.unique(np.asarray(stop_ids, dtype=np.int64)))
+        trained_columns = getattr(model, 'feature_name_', None)
+        self.columns = list(trained_columns) if trained_columns is not None and set(trained_columns) == set(FEATURE_COLUMNS) else FEATURE_COLUMNS
+
+    def feature_frame(self, route_ids, stop_ids, stop_sequences, when):
+        n = len(stop_ids); weekday = when.weekday()
+        data = {'route_id': pd.Categorical(np.asarray(route_ids, dtype=np.int64), dtype=self.route_dtype),
+                'stop_id': pd.Categorical(np.asarray(stop_ids, dtype=np.int64), dtype=self.stop_dtype),
+                'stop_sequence': np.asarray(stop_sequences, dtype=np.int64), 'hour_of_day': np.full(n, when.hour, dtype=np.int64)}
+        for day, column in enumerate(WEEKDAY_COLUMNS): data[column] = np.full(n, 1 if weekday == day else 0, dtype=np.int64)
+        return pd.DataFrame(data, columns=self.columns)
+
+    def score_here(self, route_ids, stop_ids, stop_sequences, when):
+        return np.asarray(self.model.predict(self.feature_frame(route_ids, stop_ids, stop_sequences, when)), dtype=np.float64)
+
+    @timed('model_predict')
+    def _score(self, route_ids, stop_ids, stop_sequences, when):
+        if self.pool is not None and len(stop_ids) >= self.pool.batch_rows:
+            scored = self.pool.score(route_ids, stop_ids, stop_sequences, when)
+            if scored is not None: return scored
+        return self.score_here(route_ids, stop_ids, stop_sequences, when)
+
+    @timed('segment_predict')
+    def predict(self, route_ids, stop_ids, stop_sequences, when):
+        """Predicted full travel time (seconds) for each segment, as a float array."""
+        if len(stop_ids) == 0: return np.zeros(0)
+        route_ids = np.asarray(route_ids, dtype=np.int64); stop_ids = np.asarray(stop_ids, dtype=np.int64); stop_sequences = np.asarray(stop_sequences, dtype=np.int64)
+        if self.cache is None: return self._score(route_ids, stop_ids, stop_sequences, when)
+
+        keys = list(zip(route_ids.tolist(), stop_ids.tolist(), stop_sequences.tolist()))
+        cached = self.cache.get_many(keys, when)
+        missing_keys = list(dict.fromkeys(key for key, value in zip(keys, cached) if value is None))
+        scored = {}
+        if missing_keys:
+            missing_routes, missing_stops, missing_sequences = (np.array(column, dtype=np.int64) for column in zip(*missing_keys))
+            values = self._score(missing_routes, missing_stops, missing_sequences, when).tolist()
+            self.cache.put_many(missing_keys, values, when); scored = dict(zip(missing_keys, values))
+        return np.array([scored[key] if value is None else value for key, value in zip(keys, cached)], dtype=np.float64)
+
+
+# --- Worker pool ---
+_inherited_model = None       # set in the parent just before forking, so workers share its pages instead of unpickling it
+_worker_segment_model = None
+
+def _init_worker(model_path, route_ids, stop_ids):
+    global _worker_segment_model
+    model = _inherited_model if _inherited_model is not None else joblib.load(model_path)
+    try:
+        model.set_params(n_jobs=1)   # one scoring thread per worker; the pool is the parallelism
+    except (AttributeError, ValueError):
+        pass
+    _worker_segment_model = SegmentModel(model, route_ids, stop_ids)
+
+def _score_batch(route_ids, stop_ids, stop_sequences, when):
+    return _worker_segment_model.score_here(route_ids, stop_ids, stop_sequences, when)
+
+def _ready():
+    return True
+
+class SegmentScoringPool:
+    """Worker processes that score large segment batches in parallel.
+
+    Workers are forked once the model and the memory-mapped GTFS cache are
+    loaded, so they share those pages copy-on-write; only the (route, stop,
+    sequence) columns of each chunk cross the process boundary. Create the
+    pool before starting any background thread. Where fork is unavailable,
+    workers load the model from model_path. Batches smaller than batch_rows
+    are scored by the caller, where pickling would cost more than it saves.
+    """
+
+    def __init__(self, segment_model, workers, model_path='bus_eta_model.pkl', batch_rows=2000):
+        global _inherited_model
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        if context.get_start_method() == 'fork': _inherited_model = segment_model.model
+        self.workers = workers; self.batch_rows = batch_rows; self.batches = 0; self.fallbacks = 0
+        self._executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                             initargs=(model_path, segment_model.route_dtype.categories.to_numpy(), segment_model.stop_dtype.categories.to_numpy()))
+        for future in [self._executor.submit(_ready) for _ in range(workers)]: future.result()   # start every worker now, not on the first request
+        _inherited_model = None
+
+    def score(self, route_ids, stop_ids, stop_sequences, when):
+        """Scores the rows in up to `workers` chunks; None if the pool has broken (the caller then scores in-process)."""
+        chunks = max(1, min(self.workers, len(stop_ids) // self.batch_rows))
+        try:
+            futures = [self._executor.submit(_score_batch, *columns, when) for columns in zip(*(np.array_split(values, chunks) for values in (route_ids, stop_ids, stop_sequences)))]
+            scored = np.concatenate([future.result() for future in futures])
+        except BrokenProcessPool as e:
+            self.fallbacks += 1; record_failure('SegmentScoringPool.score', e); return None
+        self.batches += 1
+        return scored
+
+    def stats(self):
+        return {'workers': self.workers, 'batches': self.batches, 'fallbacks': self.fallbacks}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,119 @@
+# tests/test_feed_decoder.py
+# The columnar VehiclePositions decoder against the generated protobuf
+# classes on random feeds. Run from the repository root: python -m pytest tests
+
+import numpy as np
+import pytest
+
+import gtfs_realtime_pb2
+from feed_decoder import IN_TRANSIT_TO, NO_VALUE, VehiclePositionsDecoder
+
+STRING_POOL = ['', 'a', 'DL1PC0001', 'route-ü', 'x' * 200]   # empty, one byte, typical, non-ASCII, multi-byte length prefix
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F; value >>= 7
+        if value: out.append(byte | 0x80)
+        else: out.append(byte); return bytes(out)
+
+def _unknown_fields(rng):
+    """A few fields no VehiclePositions message defines, in every wire type, repeated ones both unpacked and packed."""
+    field = int(rng.integers(40, 4000)); values = rng.integers(0, 1 << 40, 3).tolist()
+    choices = [_varint(field << 3 | 0) + _varint(values[0]),
+               _varint(field << 3 | 1) + bytes(8), _varint(field << 3 | 5) + bytes(4),
+               _varint(field << 3 | 2) + _varint(5) + b'hello',
+               b''.join(_varint(field << 3 | 0) + _varint(value) for value in values),   # repeated, unpacked
+               _varint(field << 3 | 2) + _varint(len(packed := b''.join(_varint(value) for value in values))) + packed]   # repeated, packed
+    return b''.join(choices[i] for i in rng.choice(len(choices), int(rng.integers(1, 4))))
+
+def _maybe_unknown(rng, message):
+    if rng.random() < 0.3: message.MergeFromString(_unknown_fields(rng))   # kept as unknown fields and serialized back
+
+def _random_feed(rng, strings, vehicles=30):
+    feed = gtfs_realtime_pb2.FeedMessage(); feed.header.gtfs_realtime_version = '2.0'
+    if rng.random() < 0.8: feed.header.timestamp = int(rng.integers(1, 1 << 40))
+    _maybe_unknown(rng, feed.header)
+    pick = lambda: strings[int(rng.integers(len(strings)))]
+    for number in range(vehicles):
+        entity = feed.entity.add(); entity.id = str(number)
+        if rng.random() < 0.1: entity.trip_update.trip.trip_id = pick(); continue   # no vehicle: not a row
+        vehicle = entity.vehicle
+        if rng.random() < 0.8:
+            vehicle.trip.SetInParent()
+            for name in ('trip_id', 'route_id', 'start_date', 'start_time'):
+                if rng.random() < 0.7: setattr(vehicle.trip, name, pick())
+            if rng.random() < 0.5: vehicle.trip.direction_id = int(rng.integers(2))
+            _maybe_unknown(rng, vehicle.trip)
+        if rng.random() < 0.85:
+            vehicle.position.latitude = float(rng.uniform(28, 29)); vehicle.position.longitude = float(rng.uniform(76, 78))
+            if rng.random() < 0.5: vehicle.position.bearing = float(rng.uniform(0, 360))
+            if rng.random() < 0.5: vehicle.position.speed = float(rng.uniform(0, 30))
+            if rng.random() < 0.5: vehicle.position.odometer = float(rng.uniform(0, 1e7))
+            _maybe_unknown(rng, vehicle.position)
+        if rng.random() < 0.9:
+            vehicle.vehicle.id = pick()
+            if rng.random() < 0.5: vehicle.vehicle.label = pick()
+        if rng.random() < 0.8: vehicle.timestamp = int(rng.integers(1, 1 << 34))
+        if rng.random() < 0.5: vehicle.current_stop_sequence = int(rng.integers(0, 1 << 20))
+        if rng.random() < 0.5: vehicle.stop_id = pick()
+        if rng.random() < 0.5: vehicle.current_status = int(rng.integers(3))
+        if rng.random() < 0.3: vehicle.congestion_level = int(rng.integers(5))
+        if rng.random() < 0.3: vehicle.occupancy_status = int(rng.integers(7))
+        _maybe_unknown(rng, vehicle); _maybe_unknown(rng, entity)
+    return feed
+
+def _optional(message, name, absent):
+    return getattr(message, name) if message.HasField(name) else absent
+
+def _check(columns, feed):
+    rows = [entity.vehicle for entity in feed.entity if entity.HasField('vehicle')]
+    assert len(columns) == len(rows)
+    assert columns.feed_timestamp == _optional(feed.header, 'timestamp', None)
+    trips = [vehicle.trip if vehicle.HasField('trip') else None for vehicle in rows]
+    text = lambda codes: columns.decode_strings(codes).tolist()
+    assert text(columns.vehicle_id) == [vehicle.vehicle.id for vehicle in rows]
+    assert text(columns.label) == [_optional(vehicle.vehicle, 'label', None) for vehicle in rows]
+    assert text(columns.trip_id) == [None if trip is None else trip.trip_id for trip in trips]
+    for name in ('route_id', 'start_date', 'start_time'):
+        assert text(getattr(columns, name)) == [None if trip is None else _optional(trip, name, None) for trip in trips]
+    assert columns.direction_id.tolist() == [NO_VALUE if trip is None else _optional(trip, 'direction_id', NO_VALUE) for trip in trips]
+    assert columns.latitude.tolist() == [vehicle.position.latitude for vehicle in rows]
+    assert columns.longitude.tolist() == [vehicle.position.longitude for vehicle in rows]
+    for name in ('bearing', 'speed', 'odometer'):
+        expected = [_optional(vehicle.position, name, np.nan) for vehicle in rows]
+        assert np.array_equal(getattr(columns, name).astype(np.float64), np.array(expected, dtype=np.float64), equal_nan=True)
+    assert columns.timestamp.tolist() == [vehicle.timestamp for vehicle in rows]
+    assert columns.current_stop_sequence.tolist() == [_optional(vehicle, 'current_stop_sequence', NO_VALUE) for vehicle in rows]
+    assert text(columns.stop_id) == [_optional(vehicle, 'stop_id', None) for vehicle in rows]
+    assert columns.current_status.tolist() == [_optional(vehicle, 'current_status', IN_TRANSIT_TO) for vehicle in rows]
+    assert columns.congestion_level.tolist() == [_optional(vehicle, 'congestion_level', NO_VALUE) for vehicle in rows]
+    assert columns.occupancy_status.tolist() == [_optional(vehicle, 'occupancy_status', NO_VALUE) for vehicle in rows]
+
+
+# --- Parity with the generated classes ---
+@pytest.mark.parametrize('seed', range(20))
+def test_random_feeds_match_generated_classes(seed):
+    rng = np.random.default_rng(seed); decoder = VehiclePositionsDecoder()
+    strings = STRING_POOL + [f"T{value}" for value in rng.integers(0, 10_000, 20).tolist()]
+    for _ in range(3):   # one decoder across calls, as the poller keeps it
+        feed = _random_feed(rng, strings)
+        _check(decoder.decode(feed.SerializeToString()), feed)
+
+def test_string_codes_are_stable_across_calls():
+    decoder = VehiclePositionsDecoder(); rng = np.random.default_rng(0)
+    first = _random_feed(rng, STRING_POOL); columns = decoder.decode(first.SerializeToString())
+    codes = dict(zip(columns.decode_strings(columns.vehicle_id).tolist(), columns.vehicle_id.tolist()))
+    second = _random_feed(rng, STRING_POOL[::-1] + ['new-id']); later = decoder.decode(second.SerializeToString())
+    _check(later, second)
+    for vehicle_id, code in zip(later.decode_strings(later.vehicle_id).tolist(), later.vehicle_id.tolist()):
+        assert codes.setdefault(vehicle_id, code) == code
+    assert len(later.strings) >= len(columns.strings)
+
+def test_empty_and_vehicle_free_feeds():
+    decoder = VehiclePositionsDecoder(); feed = gtfs_realtime_pb2.FeedMessage(); feed.header.gtfs_realtime_version = '2.0'
+    columns = decoder.decode(feed.SerializeToString())
+    assert len(columns) == 0 and columns.feed_timestamp is None and columns.to_frame() is None
+    feed.entity.add(id='1').trip_update.trip.trip_id = 'T1'
+    assert len(decoder.decode(feed.SerializeToString())) == 0
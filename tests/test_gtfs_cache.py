@@ -0,0 +1,57 @@
+# tests/test_gtfs_cache.py
+# Compiled GTFS cache round-trips on a tiny CSV feed. Run from the
+# repository root: python -m pytest tests
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gtfs_cache
+from gtfs_cache import build_gtfs_store, load_gtfs_store
+
+FEED = {'stops.csv': 'stop_id,stop_name,stop_lat,stop_lon\n1,Alpha,28.5,77.0\n2,,28.51,77.01\n3,Gamma,28.52,77.02\n',
+        'routes.csv': 'route_id,route_short_name\n10,R10\n11,\n',
+        'trips.csv': 'trip_id,route_id\nA,10\nB,11\n',
+        'stop_times.csv': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                          'A,08:00:00,08:00:00,1,1\nA,08:05:00,08:05:00,2,2\nB,24:10:00,24:10:00,2,1\nB,24:20:00,24:20:00,3,2\n'}
+
+
+@pytest.fixture
+def feed_dir(tmp_path):
+    for name, text in FEED.items(): (tmp_path / name).write_text(text)
+    return tmp_path
+
+
+# --- Tables ---
+def test_round_trip_keeps_missing_names_and_dtypes(feed_dir):
+    built = build_gtfs_store(str(feed_dir)); loaded = load_gtfs_store(str(feed_dir), str(feed_dir / 'cache'))
+    for table in ('stops_df', 'routes_df'):   # the second stop and the second route have no name
+        expected, actual = getattr(built, table), getattr(loaded, table)
+        assert list(actual.columns) == list(expected.columns)
+        for name in expected.columns:
+            if pd.api.types.is_numeric_dtype(expected[name]): assert actual[name].dtype == expected[name].dtype; continue
+            values = actual[name].tolist()
+            assert values[1] is None and 'nan' not in values
+            assert [value for value in values if value is not None] == expected[name].dropna().tolist()
+    assert loaded.trip_index.stop_id_table.dtype == built.trip_index.stop_id_table.dtype
+    assert np.array_equal(loaded.trip_index.departure_seconds, built.trip_index.departure_seconds)
+
+
+# --- Staleness ---
+def test_touched_sources_are_hashed_once(feed_dir, monkeypatch):
+    cache_dir = str(feed_dir / 'cache'); load_gtfs_store(str(feed_dir), cache_dir)
+    build = json.loads((feed_dir / 'cache' / 'manifest.json').read_text())['build']
+    stat = os.stat(feed_dir / 'stop_times.csv'); os.utime(feed_dir / 'stop_times.csv', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    load_gtfs_store(str(feed_dir), cache_dir)   # hashes, matches and records the new mtime
+    manifest = json.loads((feed_dir / 'cache' / 'manifest.json').read_text())
+    assert manifest['build'] == build and manifest['sources']['stop_times.csv']['mtime_ns'] == stat.st_mtime_ns + 10**9
+    monkeypatch.setattr(gtfs_cache, '_sha256', lambda path: pytest.fail(f"rehashed {path}"))
+    load_gtfs_store(str(feed_dir), cache_dir)
+
+def test_changed_sources_recompile(feed_dir):
+    cache_dir = str(feed_dir / 'cache'); load_gtfs_store(str(feed_dir), cache_dir)
+    (feed_dir / 'routes.csv').write_text(FEED['routes.csv'].replace('R10', 'R100'))
+    assert load_gtfs_store(str(feed_dir), cache_dir).routes_df['route_short_name'].tolist() == ['R100', None]
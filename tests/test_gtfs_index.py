@@ -0,0 +1,51 @@
+# tests/test_gtfs_index.py
+# Static GTFS indexes on a hand-written route map. Run from the repository
+# root: python -m pytest tests
+
+import pandas as pd
+import pytest
+
+from gtfs_index import SECONDS_PER_DAY, DepartureTimetable, RoutePatternIndex, TripIndex
+
+# Route 7 runs a morning trip and a late one past midnight (24:10 is 00:10 of the next day) through stop 2
+ROUTE_MAP = pd.DataFrame([('A', 7, 1, 1, 28.50, 77.00, '08:00:00', '08:00:00'), ('A', 7, 2, 2, 28.51, 77.01, '08:05:00', '08:05:00'),
+                          ('B', 7, 1, 1, 28.50, 77.00, '24:05:00', '24:05:00'), ('B', 7, 2, 2, 28.51, 77.01, '24:10:00', '24:10:00')],
+                         columns=['trip_id', 'route_id', 'stop_id', 'stop_sequence', 'stop_lat', 'stop_lon', 'arrival_time', 'departure_time'])
+MORNING = 8 * 3600 + 5 * 60; AFTER_MIDNIGHT = 10 * 60
+
+
+@pytest.fixture(scope='module')
+def trip_index():
+    return TripIndex.from_route_map(ROUTE_MAP)
+
+@pytest.fixture(scope='module')
+def timetable(trip_index):
+    return DepartureTimetable.from_trip_index(trip_index)
+
+
+# --- Stop codes ---
+def test_stop_codes_are_shared_with_the_trip_index(trip_index):
+    codes = trip_index.stop_codes_of([2, 1, 99])
+    assert codes.tolist() == [trip_index.stop_code(2), trip_index.stop_code(1), -1]
+    assert trip_index.stop_id_table[codes[:2]].tolist() == [2, 1]
+
+def test_connecting_patterns_in_stop_codes(trip_index):
+    patterns = RoutePatternIndex.from_trip_index(trip_index); first, second = trip_index.stop_codes_of([1, 2]).tolist()
+    assert len(patterns) == 1 and patterns.pattern_stop_codes.dtype == trip_index.stop_codes.dtype
+    assert patterns.connecting_patterns([first, -1], [second]) == [(0, first, second)]
+    assert patterns.connecting_patterns([second], [first]) == []
+
+
+# --- Departure timetable ---
+def test_departures_later_today(timetable, trip_index):
+    assert timetable.next_departures(7, trip_index.stop_code(2), 3600, 2).tolist() == [MORNING, SECONDS_PER_DAY + AFTER_MIDNIGHT]
+
+def test_yesterdays_service_past_midnight(timetable, trip_index):
+    # at 00:05 the 24:10 trip from yesterday's service is still to come, ten minutes after today's midnight
+    assert timetable.next_departures(7, trip_index.stop_code(2), 5 * 60, 2).tolist() == [AFTER_MIDNIGHT, MORNING]
+
+def test_rolls_into_tomorrow_after_service_ends(timetable, trip_index):
+    assert timetable.next_departures(7, trip_index.stop_code(2), 23 * 3600, 2).tolist() == [SECONDS_PER_DAY + AFTER_MIDNIGHT, SECONDS_PER_DAY + MORNING]
+
+def test_unknown_route_or_stop(timetable, trip_index):
+    assert len(timetable.next_departures(7, trip_index.stop_code(99), 0)) == 0 and len(timetable.next_departures(8, trip_index.stop_code(2), 0)) == 0
@@ -0,0 +1,100 @@
+# tests/test_journey_planner.py
+# RAPTOR planner checks on a small synthetic grid city. Run from the
+# repository root: python -m pytest tests
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_index import TripIndex, TransitNetwork
+from journey_planner import MAX_EARLY_SECONDS, MAX_LATE_SECONDS, MIN_TRANSFER_SECONDS, UNREACHED, plan_journeys
+
+GRID = 8; SPACING_DEG = 0.0045                     # about 500 m between neighbouring stops
+FIRST_DEPARTURE = 6 * 3600; LAST_DEPARTURE = 10 * 3600; HEADWAY = 600; HOP = 90
+
+
+def _stop_id(i, j):
+    return f"S{i}_{j}"
+
+def _grid_route_map():
+    """Bus routes along every row and column of the grid, both directions, every HEADWAY seconds."""
+    rows = []; trip = 0
+    for line in range(GRID):
+        for kind, base in (('row', 0), ('col', 1000)):
+            for direction in (0, 1):
+                cells = [(line, j) if kind == 'row' else (j, line) for j in range(GRID)][::-1 if direction else 1]
+                for start in range(FIRST_DEPARTURE, LAST_DEPARTURE, HEADWAY):
+                    trip += 1
+                    for sequence, (i, j) in enumerate(cells):
+                        at = start + sequence * HOP
+                        rows.append((f"T{trip}", base + line * 2 + direction, _stop_id(i, j), sequence + 1,
+                                     28.5 + i * SPACING_DEG, 77.0 + j * SPACING_DEG, at, at + 20))
+    frame = pd.DataFrame(rows, columns=['trip_id', 'route_id', 'stop_id', 'stop_sequence', 'stop_lat', 'stop_lon', 'arrival', 'departure'])
+    to_text = lambda seconds: [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds]
+    frame['arrival_time'] = to_text(frame.pop('arrival')); frame['departure_time'] = to_text(frame.pop('departure'))
+    return frame
+
+@pytest.fixture(scope='module')
+def grid():
+    trip_index = TripIndex.from_route_map(_grid_route_map())
+    return trip_index, TransitNetwork.from_trip_index(trip_index)
+
+def _check_legs(journey):
+    """Legs chain in time: every bus is boarded after the traveller gets to its stop."""
+    assert any(leg['mode'] == 'bus' for leg in journey['legs'])
+    at = journey['departure_seconds']
+    for leg in journey['legs']:
+        if leg['mode'] == 'walk': at += leg['seconds']
+        else: assert leg['departure_seconds'] >= at; at = leg['arrival_seconds']
+    assert at == journey['arrival_seconds']
+
+
+# --- Origin and target overlap ---
+def test_origin_stop_that_is_also_a_target_is_not_a_journey(grid):
+    _, network = grid
+    origins = network.stop_positions([_stop_id(2, 2), _stop_id(2, 3)]); targets = network.stop_positions([_stop_id(2, 3), _stop_id(5, 3)])
+    plan = plan_journeys(network, origins, [300, 0], targets, [0, 0], 7 * 3600)
+    assert plan.journeys
+    for journey in plan.journeys: _check_legs(journey)
+
+def test_same_origin_and_target_stops_give_no_journeys(grid):
+    _, network = grid
+    stops = network.stop_positions([_stop_id(4, 4)])
+    assert plan_journeys(network, stops, [0], stops, [0], 7 * 3600).journeys == []
+
+
+# --- Live delays against a brute-force reference ---
+def _reference_arrival(network, origins, access, targets, egress, depart_seconds, max_transfers, trip_delays):
+    """Earliest arrival trying every trip of every pattern each round, with the planner's transfer rules."""
+    labels = np.full(len(network), UNREACHED, dtype=np.int64); labels[origins] = depart_seconds + np.asarray(access)
+    by_bus = np.zeros(len(network), dtype=bool); best = UNREACHED
+    for k in range(1, max_transfers + 2):
+        ready = labels + (MIN_TRANSFER_SECONDS if k > 1 else 0); rides = labels.copy()
+        for pattern in range(len(network.pattern_route_ids)):
+            columns = range(network.pattern_offsets[pattern], network.pattern_offsets[pattern + 1])
+            for slot, trip in enumerate(network.pattern_trips[network.pattern_trip_offsets[pattern]:network.pattern_trip_offsets[pattern + 1]]):
+                on_board = False
+                for column in columns:
+                    stop = network.pattern_stops[column]; at = network.column_offsets[column] + slot
+                    if on_board: rides[stop] = min(rides[stop], network.column_arrivals[at] + trip_delays[trip])
+                    on_board = on_board or network.column_departures[at] + trip_delays[trip] >= ready[stop]
+        improved = np.flatnonzero(rides < labels); current = rides.copy()
+        for stop in improved:
+            entries = slice(network.transfer_offsets[stop], network.transfer_offsets[stop + 1])
+            np.minimum.at(current, network.transfer_stops[entries], rides[stop] + network.transfer_seconds[entries])
+        by_bus |= current < labels; labels = current
+        best = min(best, min((labels[t] + e for t, e in zip(targets, egress) if by_bus[t]), default=UNREACHED))
+    return best
+
+def test_live_delays_match_brute_force(grid):
+    trip_index, network = grid
+    rng = np.random.default_rng(7); stops = len(network)
+    for case in range(40):
+        trip_delays = np.where(rng.random(len(trip_index)) < 0.3, rng.integers(-MAX_EARLY_SECONDS, MAX_LATE_SECONDS, len(trip_index)), 0)
+        origins = rng.choice(stops, 2, replace=False); targets = rng.choice(stops, 2, replace=False)
+        access = rng.integers(0, 400, 2).tolist(); egress = rng.integers(0, 400, 2).tolist()
+        depart = int(rng.integers(FIRST_DEPARTURE, LAST_DEPARTURE - 3600))
+        plan = plan_journeys(network, origins, access, targets, egress, depart, max_transfers=2, trip_delays=trip_delays)
+        for journey in plan.journeys: _check_legs(journey)
+        expected = _reference_arrival(network, origins, access, targets, egress, depart, 2, trip_delays)
+        assert min((journey['arrival_seconds'] for journey in plan.journeys), default=UNREACHED) == expected, case
@@ -0,0 +1,24 @@
+# tests/test_prediction.py
+# Segment prediction cache behaviour around hour boundaries. Run from the
+# repository root: python -m pytest tests
+
+from datetime import datetime
+
+from prediction import SegmentPredictionCache
+
+NOW = datetime(2026, 1, 5, 10, 0, 5); EARLIER = datetime(2026, 1, 5, 9, 59, 58); LATER = datetime(2026, 1, 5, 11, 0, 1)
+
+
+def test_older_hour_bypasses_the_cache_without_clearing_it():
+    cache = SegmentPredictionCache()
+    cache.put_many([(1, 'S1', 1)], [42.0], NOW)   # e.g. the prewarm thread filling the new hour
+    assert cache.get_many([(1, 'S1', 1)], EARLIER) == [None]
+    cache.put_many([(1, 'S2', 2)], [7.0], EARLIER)
+    assert cache.get_many([(1, 'S1', 1), (1, 'S2', 2)], NOW) == [42.0, None]
+    assert cache.stats()['invalidations'] == 0
+
+def test_newer_hour_rolls_over():
+    cache = SegmentPredictionCache()
+    cache.put_many([(1, 'S1', 1)], [42.0], NOW)
+    assert cache.get_many([(1, 'S1', 1)], LATER) == [None]
+    assert cache.stats()['invalidations'] == 1 and cache.stats()['hour_bucket'] == '2026-01-05 11:00'
@@ -0,0 +1,182 @@
+# vehicle_tracker.py
+# Per-vehicle state kept across feed snapshots (as a LiveFeedPoller
+# subscriber): where each bus is on its trip, its last few fixes and how fast
+# it has actually been moving. Snapping starts from the segment a bus was last
+# seen on, progress along a trip never runs backwards, and the ETA and delay
+# code reads the tracked position instead of re-snapping every bus per request.
+
+import sys
+import threading
+import traceback
+
+import numpy as np
+
+from gtfs_index import expand_row_ranges, haversine_km_vectorized
+from metrics import registry, span
+
+HISTORY_LENGTH = 8                # fixes kept per vehicle
+SNAP_WINDOW_SEGMENTS = 6          # segments searched from the last known one onwards
+RESNAP_OFF_ROUTE_KM = 0.3         # a windowed snap further off than this rescans the whole trip
+SPEED_SMOOTHING = 0.3             # weight of the newest speed observation
+MIN_OBSERVATION_SECONDS = 5; MAX_OBSERVATION_SECONDS = 600   # fix intervals outside this range don't update speeds
+MAX_SPEED_KMH = 90
+EXPIRE_AFTER_SECONDS = 1800       # vehicles unseen for this long are forgotten
+
+# Per-slot state and its empty value
+FIELDS = {'trip_positions': (np.int64, -1), 'rows': (np.int64, -1), 'progress': (np.float64, 0.0), 'along_km': (np.float64, np.nan),
+          'seen_at': (np.float64, np.nan), 'speed_kmh': (np.float64, np.nan), 'segment_speed_kmh': (np.float64, np.nan),
+          'history_head': (np.int64, -1), 'history_count': (np.int64, 0)}
+HISTORY_FIELDS = ('history_times', 'history_lats', 'history_lons', 'history_km')
+
+
+class VehicleTracker:
+    """Tracks every live vehicle in flat arrays, one slot per vehicle_id.
+
+    A slot holds the vehicle's trip position, its current segment (a row of
+    trip_index and the fraction covered), its distance along the trip, its
+    smoothed speed overall and on the current segment, and a ring buffer of
+    its last history_length (time, lat, lon, km along) fixes. The arrays grow
+    by doubling and slots of expired vehicles are reused.
+    """
+
+    def __init__(self, trip_index, capacity=4096, history_length=HISTORY_LENGTH):
+        self.trip_index = trip_index; self.history_length = history_length
+        self.version = 0; self._slots = {}; self._free = []
+        self._vehicle_ids = np.empty(0, dtype=object)
+        for name, (dtype, _) in FIELDS.items(): setattr(self, name, np.empty(0, dtype=dtype))
+        for name in HISTORY_FIELDS: setattr(self, name, np.empty((0, history_length)))
+        self._grow(max(capacity, 1))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _grow(self, capacity):
+        added = capacity - len(self._vehicle_ids)
+        self._vehicle_ids = np.concatenate((self._vehicle_ids, np.full(added, None, dtype=object)))
+        for name, (dtype, empty) in FIELDS.items(): setattr(self, name, np.concatenate((getattr(self, name), np.full(added, empty, dtype=dtype))))
+        for name in HISTORY_FIELDS: setattr(self, name, np.concatenate((getattr(self, name), np.full((added, self.history_length), np.nan))))
+        self._free.extend(range(capacity - 1, capacity - added - 1, -1))
+
+    def _slot(self, vehicle_id):
+        slot = self._slots.get(vehicle_id)
+        if slot is None:
+            if not self._free: self._grow(2 * len(self._vehicle_ids))
+            slot = self._slots[vehicle_id] = self._free.pop(); self._vehicle_ids[slot] = vehicle_id
+        return slot
+
+    def _release(self, slots):
+        for slot in slots.tolist():
+            del self._slots[self._vehicle_ids[slot]]; self._vehicle_ids[slot] = None; self._free.append(slot)
+        for name, (_, empty) in FIELDS.items(): getattr(self, name)[slots] = empty
+        for name in HISTORY_FIELDS: getattr(self, name)[slots] = np.nan
+
+    def segment_km(self, rows):
+        """Length of the segment from each row to the next stop of its trip."""
+        rows = np.asarray(rows, dtype=np.int64)
+        lats, lons = self.trip_index.stop_coords_at(rows); next_lats, next_lons = self.trip_index.stop_coords_at(rows + 1)
+        return haversine_km_vectorized(lats, lons, next_lats, next_lons)
+
+    def _km_between(self, from_rows, to_rows):
+        """Signed distance along each trip from the stop at from_rows to the stop at to_rows (rows of the same trip)."""
+        from_rows = np.asarray(from_rows, dtype=np.int64); to_rows = np.asarray(to_rows, dtype=np.int64)
+        rows, counts, _ = expand_row_ranges(np.minimum(from_rows, to_rows), np.maximum(from_rows, to_rows))
+        km = np.bincount(np.repeat(np.arange(len(counts)), counts), weights=self.segment_km(rows), minlength=len(counts))
+        return np.where(to_rows < from_rows, -km, km)
+
+    # --- Updates ---
+    def on_snapshot(self, snapshot):
+        """Feed-poller subscriber: never raises, so a bad snapshot can't stop the poller."""
+        try:
+            with self._lock, span('vehicle_tracker_update'): self._update(snapshot)
+        except Exception:
+            registry.count_failure('VehicleTracker.on_snapshot')
+            print("Vehicle tracker failed to process snapshot; keeping the previous state.", file=sys.stderr); traceback.print_exc()
+
+    def _update(self, snapshot):
+        vehicles = snapshot.vehicles; snapshot_time = float(snapshot.feed_timestamp or snapshot.fetched_at or 0)
+        self.version = snapshot.version
+        if vehicles is None or vehicles.empty: self._expire(snapshot_time); return
+        vehicles = vehicles.drop_duplicates('vehicle_id', keep='last')
+        observed_at = vehicles['timestamp'].to_numpy(dtype=np.float64) if 'timestamp' in vehicles else np.zeros(len(vehicles))
+        observed_at = np.where(observed_at > 0, observed_at, snapshot_time)   # buses without their own timestamp get the feed's
+        slots = np.fromiter((self._slot(vehicle_id) for vehicle_id in vehicles['vehicle_id'].tolist()), dtype=np.int64, count=len(vehicles))
+
+        # Only fixes newer than what we hold; a repeated report says nothing new
+        fresh = np.flatnonzero(~(observed_at <= self.seen_at[slots]))
+        slots, observed_at = slots[fresh], observed_at[fresh]
+        trip_ids = vehicles['trip_id'].to_numpy()[fresh].tolist()
+        lats = vehicles['latitude'].to_numpy(dtype=np.float64)[fresh]; lons = vehicles['longitude'].to_numpy(dtype=np.float64)[fresh]
+        trip_positions = self.trip_index.trip_positions(trip_ids)
+        same_trip = (trip_positions >= 0) & (trip_positions == self.trip_positions[slots]) & (self.rows[slots] >= 0)
+
+        # Snap from the last known segment forwards; buses that ended up far off it get a full rescan
+        last_rows, progress, off_route_km = self.trip_index.locate_vehicles(trip_ids, lats, lons, np.where(same_trip, self.rows[slots], -1), SNAP_WINDOW_SEGMENTS)
+        lost = np.flatnonzero(same_trip & (off_route_km > RESNAP_OFF_ROUTE_KM))
+        if len(lost):
+            last_rows[lost], progress[lost], _ = self.trip_index.locate_vehicles([trip_ids[i] for i in lost], lats[lost], lons[lost])
+
+        # Distance along the trip, measured from the previous fix on the same trip (usually a segment or two away), else from its first stop
+        located = last_rows >= 0; safe_rows = np.where(located, last_rows, 0)
+        previous_rows = self.rows[slots]; previous_along = self.along_km[slots]
+        from_rows = np.where(located, np.where(same_trip, previous_rows, self.trip_index.offsets[np.maximum(trip_positions, 0)]), 0)
+        from_km = np.where(same_trip, previous_along - self.progress[slots] * self.segment_km(np.maximum(previous_rows, 0)), 0.0)
+        along_km = np.where(located, from_km + self._km_between(from_rows, safe_rows) + progress * self.segment_km(safe_rows), np.nan)
+
+        # Progress never runs backwards on the same trip: GPS jitter keeps the previous position
+        backwards = same_trip & located & (along_km < previous_along)
+        last_rows = np.where(backwards, previous_rows, last_rows); progress = np.where(backwards, self.progress[slots], progress); along_km = np.where(backwards, previous_along, along_km)
+
+        # Speeds from the distance covered along the trip since the previous fix
+        elapsed = observed_at - self.seen_at[slots]
+        kept = same_trip & located; recent = kept & (elapsed <= MAX_OBSERVATION_SECONDS)   # older speeds are dropped, not carried
+        measured = recent & (elapsed >= MIN_OBSERVATION_SECONDS)
+        speed = (along_km - previous_along) / np.where(measured, elapsed, 1.0) * 3600
+        measured &= speed <= MAX_SPEED_KMH
+        same_segment = recent & (last_rows == previous_rows)
+        self.speed_kmh[slots] = np.where(measured, _smooth(self.speed_kmh[slots], speed), np.where(recent, self.speed_kmh[slots], np.nan))
+        previous_segment_speed = np.where(same_segment, self.segment_speed_kmh[slots], np.nan)
+        self.segment_speed_kmh[slots] = np.where(measured, _smooth(previous_segment_speed, speed), previous_segment_speed)
+
+        # Ring buffer of fixes, restarted when the vehicle changes trip
+        heads = (self.history_head[slots] + 1) % self.history_length
+        self.history_count[slots] = np.minimum(np.where(kept, self.history_count[slots], 0) + 1, self.history_length); self.history_head[slots] = heads
+        self.history_times[slots, heads] = observed_at; self.history_lats[slots, heads] = lats; self.history_lons[slots, heads] = lons; self.history_km[slots, heads] = along_km
+
+        self.trip_positions[slots] = trip_positions; self.rows[slots] = last_rows; self.progress[slots] = progress
+        self.along_km[slots] = along_km; self.seen_at[slots] = observed_at
+        self._expire(snapshot_time)
+
+    def _expire(self, now):
+        stale = np.flatnonzero(self.seen_at < now - EXPIRE_AFTER_SECONDS)
+        if len(stale): self._release(stale)
+
+    # --- Reads ---
+    def lookup(self, vehicle_ids, trip_ids):
+        """Tracked (last_rows, progress, segment_speed_kmh) per bus, as from trip_index.locate_vehicles.
+
+        last_rows is -1 where the vehicle is not tracked or now reports a
+        different trip; segment_speed_kmh is NaN until a bus has been seen
+        moving on its current segment.
+        """
+        with self._lock:
+            slots = np.fromiter((self._slots.get(vehicle_id, -1) for vehicle_id in vehicle_ids), dtype=np.int64, count=len(vehicle_ids))
+            safe_slots = np.maximum(slots, 0)
+            tracked = (slots >= 0) & (self.trip_positions[safe_slots] == self.trip_index.trip_positions(list(trip_ids))) & (self.rows[safe_slots] >= 0)
+            return np.where(tracked, self.rows[safe_slots], -1), np.where(tracked, self.progress[safe_slots], 0.0), np.where(tracked, self.segment_speed_kmh[safe_slots], np.nan)
+
+    def recent_fixes(self, vehicle_id):
+        """The vehicle's last fixes, oldest first, as (timestamp, lat, lon, km along trip) tuples."""
+        with self._lock:
+            slot = self._slots.get(vehicle_id)
+            if slot is None: return []
+            count = int(self.history_count[slot]); order = (int(self.history_head[slot]) - np.arange(count)[::-1]) % self.history_length
+            return list(zip(*(getattr(self, name)[slot, order].tolist() for name in HISTORY_FIELDS)))
+
+    def stats(self):
+        with self._lock:
+            active = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+            return {'vehicles': len(active), 'with_speed': int(np.count_nonzero(~np.isnan(self.speed_kmh[active]))), 'capacity': len(self._vehicle_ids), 'snapshot_version': self.version}
+
+def _smooth(previous, observed):
+    return np.where(np.isnan(previous), observed, SPEED_SMOOTHING * observed + (1 - SPEED_SMOOTHING) * previous)